@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Merges deep configurations with configuration.data_merge and with the
+# previous implementation, which deep-copied every value.
+#
+# Usage: python benchmarks/data_merge.py [depth] [breadth] [repetitions]
+
+import copy
+import os.path
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from lib import configuration
+
+
+def copying_data_merge(a, b):
+  output = {}
+  for item, value in a.iteritems():
+    if b.has_key(item):
+      if isinstance(b[item], dict):
+        output[item] = copying_data_merge(value, b.pop(item))
+    else:
+      output[item] = copy.deepcopy(value)
+  for item, value in b.iteritems():
+    output[item] = copy.deepcopy(value)
+  return output
+
+
+def generate_config(depth, breadth, prefix):
+  result = {}
+  for i in range(breadth):
+    key = 'key%d' % i
+    if depth > 0:
+      result[key] = generate_config(depth - 1, breadth, prefix)
+    else:
+      result[key] = [ '%s-%d' % (prefix, i), '#!drush cr' ]
+
+  return result
+
+
+def generate_override(depth, breadth):
+  # Override one branch per level, like a host inheriting from a base.
+  if depth == 0:
+    return { 'key0': 'overridden' }
+
+  return { 'key0': generate_override(depth - 1, breadth), 'extra': depth }
+
+
+def benchmark(fn, base, override, repetitions, copy_override):
+  start_time = time.time()
+  for i in range(repetitions):
+    # The previous implementation consumes the override, hand it a fresh one.
+    fn(base, copy.deepcopy(override) if copy_override else override)
+
+  return (time.time() - start_time) / repetitions
+
+
+def main(depth=4, breadth=8, repetitions=20):
+  base = generate_config(depth, breadth, 'base')
+  override = generate_override(depth, breadth)
+  print 'Merging configurations with depth %d and breadth %d, %d repetitions\n' % (depth, breadth, repetitions)
+
+  # Make sure both implementations agree.
+  assert configuration.data_merge(base, override) == copying_data_merge(base, copy.deepcopy(override))
+
+  copying_time = benchmark(copying_data_merge, base, override, repetitions, True)
+  sharing_time = benchmark(configuration.data_merge, base, override, repetitions, False)
+
+  print '{name:<20} {time:10.6f}s'.format(name='deep-copying merge', time=copying_time)
+  print '{name:<20} {time:10.6f}s  ({factor:.1f}x faster)'.format(name='data_merge', time=sharing_time, factor=copying_time / sharing_time)
+
+
+if __name__ == '__main__':
+  main(*map(int, sys.argv[1:]))
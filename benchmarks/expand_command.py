@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Expands `#!executable`-commands like a reset on a big configuration does,
+# with BaseMethod and with the previous implementation, which flattened the
+# configuration and compiled the pattern again for every hook and command.
+#
+# Usage: python benchmarks/expand_command.py [hooks] [commands] [repetitions]
+
+import os.path
+import re
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from lib.methods.base import BaseMethod
+
+
+class PreviousMethod(BaseMethod):
+
+  def setExecutables(self, config):
+    self.executables = {}
+    replacements = self.expandVariables({ "host": config })
+    for key, command in config['executables'].iteritems():
+      self.executables[key] = self.expandCommands([ command ], replacements)[0]
+
+  def expandCommand(self, in_cmd):
+    cmd = in_cmd
+    if len(self.executables) > 0:
+      pattern = re.compile('|'.join(re.escape("#!" + key) for key in self.executables.keys()))
+      cmd = pattern.sub(lambda x: self.executables[x.group()[2:]], cmd)
+
+      if cmd.find('%arguments%') >= 0:
+        arr = in_cmd.split(' ')
+        command = arr.pop(0)
+        arguments = ' '.join(arr)
+        command = command.replace('#!', '');
+        cmd = self.executables[command].replace('%arguments%', arguments)
+
+    return cmd
+
+
+def generate_config():
+  config = {
+    'config_name': 'benchmark',
+    'runLocally': False,
+    'rootFolder': '/var/www/benchmark',
+    'executables': {},
+  }
+  # Names must not be prefixes of each other, the previous implementation
+  # expanded `#!mysqldump` with the executable for mysql.
+  for name in ['drush', 'git', 'composer', 'mysqldump', 'gzip', 'tar', 'rsync', 'supervisorctl']:
+    config['executables'][name] = '/usr/local/bin/%s --root=%%host.rootFolder%%' % name
+  for i in range(200):
+    config['setting%d' % i] = { 'value': 'value-%d' % i, 'nested': { 'key': i } }
+
+  return config
+
+
+def generate_commands(count):
+  templates = ['#!drush cr', '#!drush updb -y', '#!git pull origin', 'ls -la', '#!mysqldump db | #!gzip > dump.sql.gz', 'echo done']
+  return [ templates[i % len(templates)] for i in range(count) ]
+
+
+def benchmark(method, config, hooks, commands, repetitions):
+  start_time = time.time()
+  for i in range(repetitions):
+    for j in range(hooks):
+      method.setRunLocally(config)
+      for cmd in commands:
+        method.expandCommand(cmd)
+
+  return (time.time() - start_time) / repetitions
+
+
+def main(hooks=50, commands=10, repetitions=5):
+  config = generate_config()
+  command_list = generate_commands(commands)
+  print 'Expanding %d commands in %d hooks, %d repetitions\n' % (commands, hooks, repetitions)
+
+  previous = PreviousMethod('previous', None)
+  current = BaseMethod('base', None)
+  previous.setRunLocally(config)
+  current.setRunLocally(config)
+  for cmd in command_list:
+    assert previous.expandCommand(cmd) == current.expandCommand(cmd), cmd
+
+  previous_time = benchmark(previous, config, hooks, command_list, repetitions)
+  current_time = benchmark(current, config, hooks, command_list, repetitions)
+
+  print '{name:<20} {time:10.6f}s'.format(name='previous', time=previous_time)
+  print '{name:<20} {time:10.6f}s  ({factor:.1f}x faster)'.format(name='BaseMethod', time=current_time, factor=previous_time / current_time)
+
+
+if __name__ == '__main__':
+  main(*map(int, sys.argv[1:]))
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Runs tasks against a generated configuration with the recording executor,
+# so no host is touched, and measures the time spent in fabalicious itself.
+#
+# Usage: python benchmarks/orchestration.py [repetitions]
+
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from fabric.api import env, hide
+from lib import configuration
+from lib import executor
+from lib import methods
+
+FABFILE = """
+name: orchestration-benchmark
+needs: [ssh, git, drush8, files, script]
+excludeFiles: { backup: [], copyFrom: [] }
+hosts:
+  bench:
+    host: example.com
+    user: bench
+    port: 22
+    type: stage
+    rootFolder: /var/www
+    siteFolder: /sites/default
+    filesFolder: /sites/default/files
+    backupFolder: /var/backups
+    branch: master
+    database: { name: db, user: user, pass: pass }
+    reset:
+      - echo "custom reset"
+"""
+
+TASKS = [
+  ('deploy', lambda: { 'nextTasks': ['reset'] }),
+  ('reset', lambda: {}),
+  ('backup', lambda: { 'withFiles': True, 'baseName': ['bench', 'now'] }),
+  ('listBackups', lambda: { 'results': [] }),
+]
+
+
+def run_task(config, task, kwargs):
+  stdout = sys.stdout
+  sys.stdout = open(os.devnull, 'w')
+  try:
+    with hide('everything'):
+      methods.runTask(config, task, **kwargs)
+  finally:
+    sys.stdout.close()
+    sys.stdout = stdout
+
+
+def main(repetitions=50):
+  folder = tempfile.mkdtemp()
+  try:
+    with open(folder + '/fabfile.yaml', 'w') as stream:
+      stream.write(FABFILE)
+    configuration.fabfile_basedir = folder
+    env.noConfigCache = True
+
+    config = configuration.get('bench')
+    configuration.apply(config, 'bench')
+    env.host_string = 'bench@example.com:22'
+
+    print 'Running tasks with the recording executor, %d repetitions\n' % repetitions
+    print '{task:<15} {commands:>9} {time:>12}'.format(task='task', commands='commands', time='per run')
+    for task, kwargs in TASKS:
+      recorder = executor.RecordingBackend(verbose=False)
+      executor.set_backend(recorder)
+      run_task(config, task, kwargs())
+      commands = len(recorder.entries)
+
+      start_time = time.time()
+      for i in range(repetitions):
+        run_task(config, task, kwargs())
+      duration = (time.time() - start_time) / repetitions
+
+      print '{task:<15} {commands:>9} {time:>11.6f}s'.format(task=task, commands=commands, time=duration)
+  finally:
+    shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+  main(*map(int, sys.argv[1:]))
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Measures the import time of fabalicious' modules and their heavier
+# dependencies. Every import runs in a fresh interpreter, so the numbers
+# include everything a module pulls in.
+#
+# Usage: python benchmarks/startup.py [repetitions]
+
+import os.path
+import subprocess
+import sys
+
+root_folder = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+MODULES = [
+  'yaml',
+  'urllib2',
+  'multiprocessing',
+  'fabric.api',
+  'lib.utils',
+  'lib.executor',
+  'lib.configuration',
+  'lib.methods',
+  'lib.methods.ssh',
+  'lib.methods.git',
+  'lib.methods.drush',
+  'lib.methods.files',
+  'lib.methods.scripts',
+  'lib.methods.composer',
+  'lib.methods.docker',
+  'lib.methods.slack',
+  'lib.methods.drupalconsole',
+  'lib.methods.platform',
+]
+
+SCRIPT = """
+import sys, time
+sys.path.append(%r)
+start_time = time.time()
+import %s
+print time.time() - start_time
+"""
+
+# The methods a host-configuration with the default needs loads.
+DEFAULT_NEEDS = """
+import sys, time
+sys.path.append(%r)
+start_time = time.time()
+from lib import methods
+for name in ['ssh', 'git', 'drush7', 'files', 'script']:
+  methods.getMethod(name)
+print time.time() - start_time
+"""
+
+
+def measure(script, repetitions):
+  times = []
+  for i in range(repetitions):
+    output = subprocess.check_output([ sys.executable, '-W', 'ignore', '-c', script ])
+    times.append(float(output.strip()))
+
+  return min(times)
+
+
+def main(repetitions=5):
+  print 'Import times in a fresh interpreter, best of %d\n' % repetitions
+
+  for module in MODULES:
+    duration = measure(SCRIPT % (root_folder, module), repetitions)
+    print '{module:<30} {time:8.1f}ms'.format(module=module, time=duration * 1000)
+
+  duration = measure(DEFAULT_NEEDS % root_folder, repetitions)
+  print '\n{module:<30} {time:8.1f}ms'.format(module='methods for default needs', time=duration * 1000)
+
+
+if __name__ == '__main__':
+  main(*map(int, sys.argv[1:]))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Parses a large generated fabfile.yaml with the pure-python and the libyaml
+# based safe loader.
+#
+# Usage: python benchmarks/yaml_loader.py [number-of-hosts] [repetitions]
+
+import os.path
+import sys
+import time
+import yaml
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from lib import configuration
+
+
+def generate_fabfile(num_hosts):
+  data = {
+    'name': 'benchmark',
+    'needs': ['ssh', 'git', 'drush8', 'files'],
+    'hosts': {},
+    'dockerHosts': {},
+    'scripts': {
+      'test': ['cd %host.gitRootFolder%', '#!composer install', '#!drush cr']
+    }
+  }
+
+  for i in range(num_hosts):
+    data['hosts']['host-%d' % i] = {
+      'host': 'host-%d.example.com' % i,
+      'user': 'deploy',
+      'port': 22,
+      'type': 'prod' if i % 2 else 'dev',
+      'rootFolder': '/var/www/host-%d' % i,
+      'siteFolder': '/sites/default',
+      'filesFolder': '/sites/default/files',
+      'backupFolder': '/var/backups/host-%d' % i,
+      'branch': 'feature/%d' % i,
+      'database': { 'name': 'db_%d' % i, 'user': 'user', 'pass': 'pass' },
+      'docker': { 'configuration': 'docker-%d' % (i % 10), 'name': 'container_%d' % i },
+      'reset': [ 'echo "reset %d"' % i, '#!drush cim -y' ]
+    }
+
+  for i in range(10):
+    data['dockerHosts']['docker-%d' % i] = {
+      'host': 'docker-%d.example.com' % i,
+      'user': 'root',
+      'port': 22,
+      'rootFolder': '/var/docker',
+      'tasks': { 'run': [ 'docker-compose up -d' ], 'stop': [ 'docker-compose stop' ] }
+    }
+
+  return configuration.yaml_dump(data, default_flow_style=False)
+
+
+def benchmark(loader, content, repetitions):
+  start_time = time.time()
+  for i in range(repetitions):
+    yaml.load(content, Loader=loader)
+
+  return (time.time() - start_time) / repetitions
+
+
+def main(num_hosts=1000, repetitions=3):
+  content = generate_fabfile(num_hosts)
+  print 'Parsing a fabfile with %d hosts (%d KB), %d repetitions' % (num_hosts, len(content) / 1024, repetitions)
+  print 'fabalicious uses %s\n' % configuration.YamlLoader.__name__
+
+  python_time = benchmark(yaml.SafeLoader, content, repetitions)
+  print '{name:<14} {time:8.3f}s'.format(name='SafeLoader', time=python_time)
+
+  if not hasattr(yaml, 'CSafeLoader'):
+    print 'CSafeLoader    not available, install pyyaml with libyaml-support.'
+    return
+
+  c_time = benchmark(yaml.CSafeLoader, content, repetitions)
+  print '{name:<14} {time:8.3f}s  ({factor:.1f}x faster)'.format(name='CSafeLoader', time=c_time, factor=python_time / c_time)
+
+
+if __name__ == '__main__':
+  main(*map(int, sys.argv[1:]))
@@ -9,8 +9,10 @@ from fabric.state import output
 import os.path
 import time
 import datetime
+import json
 import sys
 from fabric.main import list_commands
+from fabric.tasks import Task
 
 # Import our modules.
 root_folder = os.path.dirname(os.path.realpath(os.path.dirname(__file__) + '/fabfile.py'))
@@ -18,16 +20,20 @@ sys.path.append(root_folder)
 from lib import methods
 from lib import configuration
 from lib import blueprints
+from lib import history
+from lib.executor import run, local, get
 
 configuration.fabfile_basedir = root_folder
 
 
 @task
+@history.recorded
 def config(configName='local'):
   c = configuration.get(configName)
   configuration.apply(c, configName)
 
 @task
+@history.recorded
 def blueprint(branch, configName=False, output=False):
   template = blueprints.getTemplate(configName)
   if not template:
@@ -43,6 +49,7 @@ def blueprint(branch, configName=False, output=False):
     config(c['configName'])
 
 @task
+@history.recorded
 def getProperty(in_key):
   configuration.check()
   with hide('output', 'running', 'warnings'):
@@ -73,6 +80,7 @@ def about_helper(key, value, indent):
 
 
 @task
+@history.recorded
 def about(config_name=False):
   if not config_name:
     config = configuration.current()
@@ -91,32 +99,38 @@ def about(config_name=False):
 
 
 @task
+@history.recorded
 def info():
   print green('Fabalicious %s by Factorial.io. MIT Licensed.\n\n' % configuration.fabalicious_version)
 
 @task
+@history.recorded
 def version():
   configuration.check('git')
   version = methods.call('git', 'getVersion', configuration.current())
   print green('%s @ %s tagged with: %s' % (configuration.getSettings('name'), configuration.current('config_name'), version))
 
 @task
+@history.recorded
 def drush(drush_command):
   configuration.check(['drush7', 'drush8'])
   methods.call('drush', 'drush', configuration.current(), command=drush_command)
 
 @task
+@history.recorded
 def drupalconsole(drupal_command):
   configuration.check(['drupalconsole'])
   methods.call('drupalconsole', 'drupalconsole', configuration.current(), command=drupal_command)
 
 @task
+@history.recorded
 def composer(composer_command):
   configuration.check(['composer'])
   methods.call('composer', 'composer', configuration.current(), command=composer_command)
 
 
 @task
+@history.recorded
 def list():
   config = configuration.getAll()
   print('Found configurations for "%s":' % config['name']+"\n")
@@ -126,12 +140,102 @@ def list():
     print '- ' + key
 
 @task
+@history.recorded
+def configCache():
+  configuration.getAll()
+  stats = configuration.config_cache_stats
+  print 'Configuration-file:   %s' % stats['configFile']
+  print 'Configuration-cache:  %s' % stats['status']
+  print 'Load time:            %.3fs' % stats['loadTime']
+  stats = configuration.host_configurations_stats
+  print 'Host-configurations:  %d hits, %d misses' % (stats['hits'], stats['misses'])
+
+@task
+@history.recorded
+def compileConfig():
+  filename = configuration.compile_configuration()
+  print green('Compiled configuration written to %s' % filename)
+
+@task
+@history.recorded
+def validateAll(report=False, workers=False):
+  result = configuration.validate_all_configurations(int(workers) if workers else False)
+
+  for kind in ['hosts', 'dockerHosts']:
+    for name in sorted(result[kind].keys()):
+      for key, msg in sorted(result[kind][name]['errors'].iteritems()):
+        print red('Key \'%s\' in %s %s: %s' % (key, kind, name, msg))
+
+  if report:
+    with open(report, 'w') as stream:
+      json.dump(result, stream, indent=2, sort_keys=True)
+    print 'Report written to %s' % report
+
+  count = len(result['hosts']) + len(result['dockerHosts'])
+  if not result['valid']:
+    print red('Validated %d configurations in %.2fs, found errors.' % (count, result['time']))
+    exit(1)
+
+  print green('Validated %d configurations in %.2fs, no errors found.' % (count, result['time']))
+
+@task
+@history.recorded
+def fleet(task, configs=False, tag=False, workers=4, onFailure='continue', **kwargs):
+  from lib import fleet
+
+  if task not in globals() or not isinstance(globals()[task], Task) or task == 'fleet':
+    print red('Unknown task "%s"' % task)
+    exit(1)
+
+  names = fleet.get_host_names(configs, tag)
+  if not names:
+    print red('No configuration matches the given configs or tag.')
+    exit(1)
+
+  print yellow('Running %s on %d configurations: %s' % (task, len(names), ', '.join(names)))
+  results = fleet.run(names, globals()[task], kwargs, int(workers), onFailure)
+  fleet.print_summary(names, results)
+
+  if any(result['status'] != 'ok' for result in results.values()):
+    exit(1)
+
+@task
+@history.recorded
+def stats(task=False, config=False):
+  history.print_stats(history.get_stats(task, config))
+
+@task
+@history.recorded
+def tunnels(close=False):
+  from lib import tunnelbroker
+
+  if close:
+    closed = tunnelbroker.close_tunnels(False if close in [ True, 'all' ] else close)
+    if closed is not False:
+      print green('Closed %d tunnel(s).' % len(closed))
+  tunnelbroker.print_tunnels(tunnelbroker.list_tunnels())
+
+@task
+@history.recorded
+def dispatchPlan(taskName):
+  configuration.check()
+
+  for phase, groups in methods.get_dispatch_plan(configuration.current(), taskName):
+    print green(phase)
+    for group in groups:
+      for fn in group:
+        parallel = ' (parallel)' if len(group) > 1 else ''
+        print '  - %s (%s.%s)%s' % (fn.im_self.methodName, fn.im_class.__name__, fn.__name__, parallel)
+
+@task
+@history.recorded
 def reset(**kwargs):
   configuration.check()
 
   methods.runTask(configuration.current(), 'reset', **kwargs)
 
 @task
+@history.recorded
 def ssh():
   configuration.check(['ssh'])
   methods.call('ssh', 'openShell', configuration.current())
@@ -139,6 +243,7 @@ def ssh():
 
 
 @task
+@history.recorded
 def putFile(fileName):
   configuration.check()
   if configuration.current()['runLocally']:
@@ -148,12 +253,14 @@ def putFile(fileName):
   methods.call('files', 'put', configuration.current(), filename=fileName)
 
 @task
+@history.recorded
 def getFile(remotePath, localPath='./'):
   configuration.check()
 
   methods.call('files', 'get', configuration.current(), remotePath=remotePath, localPath=localPath)
 
 @task
+@history.recorded
 def getSQLDump():
   configuration.check()
 
@@ -172,6 +279,7 @@ def getSQLDump():
     run('rm ' + file_name);
 
 @task
+@history.recorded
 def backup(withFiles = True):
   configuration.check()
   print green('backing up files and database of "%s" @ "%s"' % (configuration.getSettings('name'), configuration.current('config_name')))
@@ -184,10 +292,12 @@ def backup(withFiles = True):
   methods.runTask(configuration.current(), 'backup', withFiles = withFiles, baseName = basename)
 
 @task
+@history.recorded
 def backupDB():
   backup(withFiles=False)
 
 @task
+@history.recorded
 def listBackups(commit = False):
   configuration.check()
   results = []
@@ -208,6 +318,12 @@ def listBackups(commit = False):
 
     print "{date} {time}  |  {commit:<30}  |  {method:<10}  |  {file}".format(**result)
 
+@task
+@history.recorded
+def rebuildBackupManifest():
+  configuration.check()
+  methods.runTask(configuration.current(), 'rebuildBackupManifest')
+
 def get_backup_files(commit):
   results = []
   methods.runTask(configuration.current(), 'listBackups', results = results)
@@ -232,6 +348,7 @@ def get_backup_files(commit):
     return filter(lambda r: r['hash'] == hash, results)
 
 @task
+@history.recorded
 def getBackup(commit):
   configuration.check()
   files = get_backup_files(commit)
@@ -242,6 +359,7 @@ def getBackup(commit):
     get(remote_path=remotePath, local_path=localPath)
 
 @task
+@history.recorded
 def restore(commit, cleanupBeforeRestore=0):
   configuration.check()
   files = get_backup_files(commit)
@@ -250,6 +368,7 @@ def restore(commit, cleanupBeforeRestore=0):
   reset()
 
 @task
+@history.recorded
 def script(scriptKey = False, *args, **kwargs):
   configuration.check()
   scripts = configuration.current('scripts')
@@ -289,11 +408,13 @@ def script(scriptKey = False, *args, **kwargs):
     methods.call('script', 'runScript', configuration.current(), script=scriptData, variables=variables)
 
 @task
+@history.recorded
 def docker(command = False, **kwargs):
   configuration.check()
   methods.call('docker', 'runCommand', configuration.current(), command = command, **kwargs)
 
 @task
+@history.recorded
 def deploy(overrideBranch=False):
   configuration.check()
   config = configuration.current()
@@ -307,17 +428,20 @@ def deploy(overrideBranch=False):
 
 
 @task
+@history.recorded
 def notify(message):
   configuration.check()
   methods.runTask(configuration.current(), 'notify', message=message)
 
 @task
+@history.recorded
 def copyFilesFrom(source_config_name):
   configuration.check()
   source_configuration = configuration.get(source_config_name)
   methods.runTask(configuration.current(), 'copyFilesFrom', source_config=source_configuration)
 
 @task
+@history.recorded
 def copyDBFrom(source_config_name):
   configuration.check()
   source_configuration = configuration.get(source_config_name)
@@ -325,17 +449,20 @@ def copyDBFrom(source_config_name):
 
 
 @task
+@history.recorded
 def copyFrom(source_config_name):
   configuration.check()
   copyDBFrom(source_config_name)
   copyFilesFrom(source_config_name)
 
 @task
+@history.recorded
 def restoreSQLFromFile(full_file_name):
   configuration.check()
   methods.runTask(configuration.current(), 'restoreSQLFromFile', sourceFile = full_file_name)
 
 @task
+@history.recorded
 def install(**kwargs):
   configuration.check()
   config = configuration.current()
@@ -347,6 +474,7 @@ def install(**kwargs):
 
 
 @task
+@history.recorded
 def createApp(**kwargs):
   configuration.check(['docker'])
   stages = [
@@ -379,6 +507,7 @@ def createApp(**kwargs):
 
 
 @task
+@history.recorded
 def destroyApp(**kwargs):
   configuration.check(['docker'])
   stages = configuration.getSettings('destroyAppStages', [
@@ -400,7 +529,8 @@ def createDestroyHelper(stages, command, **kwargs):
 
     hostConfig = {}
     for key in ['host', 'user', 'port']:
-      hostConfig[key] = configuration.current()[key],
+      # The port of a tunneled configuration is allocated with its tunnel.
+      hostConfig[key] = configuration.current().get(key),
 
     methods.call(step['connection'], 'getHostConfig', configuration.current(), hostConfig=hostConfig)
     hostString = join_host_strings(**hostConfig)
@@ -409,6 +539,7 @@ def createDestroyHelper(stages, command, **kwargs):
 
 
 @task
+@history.recorded
 def updateApp(**kwargs):
   configuration.check()
   config = configuration.current()
@@ -419,11 +550,13 @@ def updateApp(**kwargs):
   methods.runTask(configuration.current(), 'updateApp', **kwargs)
 
 @task
+@history.recorded
 def doctor(**kwargs):
   configuration.check()
   methods.runTask(configuration.current(), 'doctor', **kwargs)
 
 @task
+@history.recorded
 def completions(type='fish'):
   output.status = False
   if type == 'fish':
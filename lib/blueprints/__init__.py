@@ -1,4 +1,3 @@
-import yaml
 import re
 from fabric.colors import green, red, yellow
 from lib import configuration
@@ -91,5 +90,5 @@ def apply(identifier, template):
 
 def output(config):
   data = { 'hosts': { config['configName']: config } }
-  print yaml.dump(data, default_flow_style=False, default_style='')
+  print configuration.yaml_dump(data, default_flow_style=False, default_style='')
 
@@ -2,12 +2,23 @@ from fabric.api import *
 from fabric.state import output, env
 from fabric.colors import green, red, yellow
 import os.path
-import urllib2
 import yaml
 import copy
 import hashlib
 import sys
-from lib.utils import validate_dict
+import glob
+import collections
+import time
+import cPickle as pickle
+import json
+import socket
+from lib.utils import allocate_port, validate_dict
+
+# Prefer the libyaml-based implementations, they are a magnitude faster.
+try:
+  from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError:
+  from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
 
 fabalicious_version = '2.2.0'
 
@@ -20,65 +31,180 @@ env.use_shell = False
 
 fabfile_basedir = False
 
+# Timeout in seconds and number of parallel requests when fetching remote configurations.
+remote_config_timeout = 10
+remote_config_workers = 8
 
-def load_all_yamls_from_dir(path):
-  result = {}
-  files = glob.glob(path+'/*.yaml') + glob.glob(path+'/*.yml')
+# Fetched remote configurations, keyed by their url.
+remote_configurations = {}
 
-  for file in files:
-    try:
-      stream = open(file, 'r')
-      data = yaml.load(stream)
+# Paths of all local files read while loading the configuration, False if not
+# recording. Used to key the compiled configuration-cache.
+config_inputs = False
+config_cacheable = True
+config_cache_stats = { 'status': 'unknown', 'loadTime': 0, 'configFile': False }
+
+# Content of a valid fabfile.compiled.json and the names of the configurations
+# served from it.
+lockfile_data = False
+lockfile_ignore = False
+locked_names = { 'hosts': set(), 'dockerHosts': set() }
+
+# Built host-configurations of this run, keyed by name. The generation changes
+# whenever the underlying configuration changes and invalidates all entries.
+host_configurations = {}
+host_configurations_generation = 0
+host_configurations_stats = { 'hits': 0, 'misses': 0 }
+
+# Local ports of ssh-tunnels without a port and localPort, keyed by name. They
+# are allocated once per run and are not part of the built configurations, so
+# compiled configurations do not pin them.
+tunnel_ports = {}
+
+
+def yaml_load(stream):
+  return yaml.load(stream, Loader=YamlLoader)
+
+
+def yaml_dump(data, stream=None, **kwargs):
+  return yaml.dump(data, stream, Dumper=YamlDumper, **kwargs)
+
+
+def track_config_input(path):
+  if config_inputs is not False:
+    config_inputs.append(os.path.abspath(path))
+
+
+class LazyYamlDirectory(collections.MutableMapping):
+  """Maps the yaml-files of a folder by their basename, a file gets parsed on first access."""
+
+  def __init__(self, path, defaults=None, overrides=None):
+    self.path = path
+    self.files = {}
+    self.data = {}
+    self.defaults = defaults if defaults else {}
+    self.overrides = overrides if overrides else {}
+
+    # Track the folder itself, so added or removed files invalidate the cache.
+    track_config_input(path)
+
+    for file in glob.glob(path+'/*.yaml') + glob.glob(path+'/*.yml'):
+      track_config_input(file)
       key = os.path.basename(file)
       key = os.path.splitext(key)[0]
-      result[key] = data
+      self.files[key] = file
 
-    except IOError as e:
-      print red('Could not read from %s' % file)
-      print red(e)
-  return result
+  def load(self, key):
+    data = self.defaults[key] if key in self.defaults else None
+
+    if key in self.files:
+      try:
+        stream = open(self.files[key], 'r')
+        file_data = yaml_load(stream)
+        data = data_merge(data, file_data) if isinstance(data, dict) and isinstance(file_data, dict) else file_data
+
+      except IOError as e:
+        print red('Could not read from %s' % self.files[key])
+        print red(e)
+        del self.files[key]
+        if data is None:
+          raise KeyError(key)
+
+    if key in self.overrides:
+      override_data = self.overrides[key]
+      data = data_merge(data, override_data) if isinstance(data, dict) and isinstance(override_data, dict) else override_data
+
+    return data
+
+  def __getitem__(self, key):
+    if key not in self.data:
+      if key not in self:
+        raise KeyError(key)
+      self.data[key] = self.load(key)
+
+    return self.data[key]
+
+  def __setitem__(self, key, value):
+    self.data[key] = value
+
+  def __delitem__(self, key):
+    if key not in self:
+      raise KeyError(key)
+    for d in [self.data, self.files, self.defaults, self.overrides]:
+      d.pop(key, None)
+
+  def __contains__(self, key):
+    return key in self.data or key in self.files or key in self.defaults or key in self.overrides
+
+  def __iter__(self):
+    return iter(set(self.data) | set(self.files) | set(self.defaults) | set(self.overrides))
+
+  def __len__(self):
+    return len(set(self.data) | set(self.files) | set(self.defaults) | set(self.overrides))
 
 
 
 def load_configuration(input_file):
   # print "Reading configuration from %s" % input_file
 
+  track_config_input(input_file)
   stream = open(input_file, 'r')
-  data = yaml.load(stream)
+  data = yaml_load(stream)
 
   if 'hosts' not in data:
     data['hosts'] = {}
   if 'dockerHosts' not in data:
     data['dockerHosts'] = {}
 
-  if (os.path.basename(input_file) == 'index.yaml'):
-    path = os.path.dirname(input_file)
-    data['hosts'] = load_all_yamls_from_dir(path + "/hosts")
-    data['dockerHosts'] = load_all_yamls_from_dir(path + "/dockerHosts")
+  # hosts and dockerHosts of an index.yaml are read from their folders on demand.
+  use_folders = os.path.basename(input_file) == 'index.yaml'
+  if use_folders:
+    data['hosts'] = {}
+    data['dockerHosts'] = {}
 
-  data = resolve_inheritance(data, {})
+  prefetch_remote_configurations(get_remote_references(data, {}))
+  data = InheritanceResolver({}).resolve(data)
   if 'requires' in data:
     check_fabalicious_version(data['requires'], 'file ' + input_file)
 
+  if use_folders:
+    path = os.path.dirname(input_file)
+    data['hosts'] = LazyYamlDirectory(path + "/hosts", data['hosts'])
+    data['dockerHosts'] = LazyYamlDirectory(path + "/dockerHosts", data['dockerHosts'])
+
   override_filename = find_configfiles(['fabfile.local.yaml'], 3)
   if override_filename:
     print yellow('Using overrides from %s' % override_filename)
-    override_data = yaml.load(open(override_filename, 'r'))
+    track_config_input(override_filename)
+    override_data = yaml_load(open(override_filename, 'r'))
+
+    # Apply overrides for lazy loaded hosts when they get loaded.
+    for key in ['hosts', 'dockerHosts']:
+      if isinstance(data[key], LazyYamlDirectory) and key in override_data:
+        data[key].overrides = override_data.pop(key)
+
     data = data_merge(data, override_data)
 
   return data
 
 
+def find_configuration_file():
+  candidates = ['fabfile.yaml', 'fabalicious/index.yaml', 'fabfile.yaml.inc']
+  return find_configfiles(candidates, 3)
+
+
 def get_all_configurations():
   global fabfile_basedir
   # Find our configuration-file:
-  candidates = ['fabfile.yaml', 'fabalicious/index.yaml', 'fabfile.yaml.inc']
-
-  config_file_name = find_configfiles(candidates, 3)
+  config_file_name = find_configuration_file()
   if (config_file_name):
     fabfile_basedir = os.path.dirname(config_file_name)
     try:
-      return load_configuration(config_file_name)
+      data = lockfile_load(config_file_name)
+      if data:
+        return data
+
+      return load_configuration_cached(config_file_name)
     except IOError:
       print "could not read from %s " % (config_file_name)
   else:
@@ -86,6 +212,306 @@ def get_all_configurations():
 
   exit(1)
 
+def config_cache_enabled():
+  return not env.get('noConfigCache', False)
+
+
+def config_cache_get_fingerprint(paths):
+  result = []
+  for path in paths:
+    try:
+      result.append((path, os.path.getmtime(path)))
+    except OSError:
+      result.append((path, False))
+
+  return result
+
+
+def config_cache_load(config_file_name):
+  try:
+    filename = get_cache_filename(config_file_name, '.config-cache')
+    with open(filename, 'rb') as stream:
+      entry = pickle.load(stream)
+  except Exception:
+    return False
+
+  if entry['version'] != fabalicious_version:
+    return False
+  if entry['override'] != find_configfiles(['fabfile.local.yaml'], 3):
+    return False
+  paths = [path for path, mtime in entry['inputs']]
+  if entry['inputs'] != config_cache_get_fingerprint(paths):
+    return False
+
+  if entry['override']:
+    print yellow('Using overrides from %s' % entry['override'])
+
+  for path in paths:
+    track_config_input(path)
+
+  return entry['data']
+
+
+def config_cache_save(config_file_name, paths, data):
+  entry = {
+    'version': fabalicious_version,
+    'override': find_configfiles(['fabfile.local.yaml'], 3),
+    'inputs': config_cache_get_fingerprint(sorted(set(paths))),
+    'data': data
+  }
+  filename = get_cache_filename(config_file_name, '.config-cache')
+  try:
+    # Write to a temporary file first, so concurrent runs never read a partial cache.
+    with open(filename + '.tmp', 'wb') as stream:
+      pickle.dump(entry, stream, pickle.HIGHEST_PROTOCOL)
+    os.rename(filename + '.tmp', filename)
+  except (IOError, OSError, pickle.PicklingError) as e:
+    print yellow('Could not write configuration-cache to %s: %s' % (filename, e))
+
+
+def load_configuration_cached(input_file):
+  global config_inputs, config_cacheable
+
+  start_time = time.time()
+  data = False
+  if not config_cache_enabled():
+    status = 'disabled'
+  else:
+    data = config_cache_load(input_file)
+    status = 'hit'
+
+  if not data:
+    # Keep recording, if somebody else is already interested in our inputs.
+    recording = config_inputs is not False
+    if not recording:
+      config_inputs = []
+    config_cacheable = True
+    try:
+      data = load_configuration(input_file)
+      if status != 'disabled':
+        if config_cacheable:
+          config_cache_save(input_file, config_inputs, data)
+          status = 'miss'
+        else:
+          # Remote resources can change without us noticing, never cache them.
+          status = 'uncacheable'
+    finally:
+      if not recording:
+        config_inputs = False
+
+  config_cache_stats['status'] = status
+  config_cache_stats['loadTime'] = time.time() - start_time
+  config_cache_stats['configFile'] = input_file
+
+  return data
+
+
+def lockfile_get_filename(config_file_name):
+  return os.path.dirname(config_file_name) + '/fabfile.compiled.json'
+
+
+def lockfile_get_hash(base_dir, sources):
+  m = hashlib.sha1()
+  for source in sources:
+    path = os.path.normpath(os.path.join(base_dir, source))
+    m.update(source + '\0')
+    if os.path.isdir(path):
+      m.update('\0'.join(sorted(os.listdir(path))))
+    elif os.path.isfile(path):
+      with open(path, 'rb') as stream:
+        m.update(stream.read())
+    else:
+      m.update('missing')
+    m.update('\0')
+
+  return m.hexdigest()
+
+
+def lockfile_encode_strings(data):
+  # json returns unicode-strings only, the rest of fabalicious expects str.
+  if isinstance(data, dict):
+    return dict((lockfile_encode_strings(key), lockfile_encode_strings(value)) for key, value in data.iteritems())
+  elif isinstance(data, list):
+    return [ lockfile_encode_strings(value) for value in data ]
+  elif isinstance(data, unicode):
+    return data.encode('utf-8')
+
+  return data
+
+
+def lockfile_load(config_file_name):
+  global lockfile_data
+
+  filename = lockfile_get_filename(config_file_name)
+  if lockfile_ignore or not os.path.exists(filename):
+    return False
+
+  start_time = time.time()
+  try:
+    with open(filename, 'r') as stream:
+      lock = lockfile_encode_strings(json.load(stream))
+  except (IOError, ValueError) as e:
+    print yellow('Could not read %s, ignoring it: %s' % (filename, e))
+    return False
+
+  base_dir = os.path.dirname(filename)
+  override_filename = find_configfiles(['fabfile.local.yaml'], 3)
+  if override_filename:
+    override_filename = os.path.relpath(override_filename, base_dir)
+
+  if lock['fabaliciousVersion'] != fabalicious_version \
+      or lock['override'] != override_filename \
+      or lock['hash'] != lockfile_get_hash(base_dir, lock['sources']):
+    print yellow('%s is outdated, ignoring it. Run "fab compileConfig" to update it.' % filename)
+    return False
+
+  lockfile_data = lock
+  locked_names['hosts'] = set(lock['hosts'].keys())
+  locked_names['dockerHosts'] = set(lock['dockerHosts'].keys())
+
+  data = lock['settings']
+  data['hosts'] = lock['hosts']
+  data['dockerHosts'] = lock['dockerHosts']
+
+  config_cache_stats['status'] = 'lockfile'
+  config_cache_stats['loadTime'] = time.time() - start_time
+  config_cache_stats['configFile'] = config_file_name
+
+  return data
+
+
+def reset_configuration():
+  """Forgets the loaded configuration and the lockfile it was read from."""
+  global root_data, lockfile_data
+
+  root_data = 0
+  lockfile_data = False
+  locked_names['hosts'] = set()
+  locked_names['dockerHosts'] = set()
+
+
+def compile_configuration():
+  """Writes a lockfile with all hosts and dockerHosts fully resolved."""
+  global config_inputs, lockfile_ignore
+
+  config_file_name = find_configuration_file()
+  if not config_file_name:
+    print red('could not find suitable configuration file!')
+    exit(1)
+
+  filename = lockfile_get_filename(config_file_name)
+  base_dir = os.path.dirname(filename)
+
+  reset_configuration()
+  config_inputs = []
+  lockfile_ignore = True
+  try:
+    settings = getAll()
+
+    hosts = {}
+    errors = {}
+    for name in sorted(settings['hosts'].keys()):
+      try:
+        hosts[name], host_errors = build_configuration(name)
+      except SystemExit:
+        hosts[name] = dict(settings['hosts'][name])
+        host_errors = { 'config': 'Resolving the configuration failed, see the output of "fab compileConfig"' }
+      if host_errors:
+        errors[name] = host_errors
+        print yellow('Configuration %s is incomplete, using it will fail.' % name)
+
+    docker_hosts = {}
+    for name in settings['dockerHosts'].keys():
+      try:
+        docker_config = resolve_inheritance(dict(settings['dockerHosts'][name]), settings['dockerHosts'], name)
+      except SystemExit:
+        print yellow('Docker-configuration %s could not be resolved, it is not compiled.' % name)
+        continue
+      docker_hosts[name] = docker_config
+
+    sources = sorted(set(os.path.relpath(path, base_dir) for path in config_inputs))
+  finally:
+    config_inputs = False
+    lockfile_ignore = False
+
+  override_filename = find_configfiles(['fabfile.local.yaml'], 3)
+
+  lock = {
+    'fabaliciousVersion': fabalicious_version,
+    'override': os.path.relpath(override_filename, base_dir) if override_filename else False,
+    'sources': sources,
+    'hash': lockfile_get_hash(base_dir, sources),
+    'settings': dict((key, value) for key, value in settings.iteritems() if key not in ['hosts', 'dockerHosts']),
+    'hosts': hosts,
+    'errors': errors,
+    'dockerHosts': docker_hosts
+  }
+
+  with open(filename, 'w') as stream:
+    json.dump(lock, stream, indent=2, sort_keys=True, default=str)
+
+  return filename
+
+
+def validate_worker(job):
+  kind, name = job
+  start_time = time.time()
+  try:
+    if kind == 'hosts':
+      config, errors = build_configuration(name)
+    else:
+      config, errors = build_docker_configuration(name)
+  except SystemExit:
+    errors = { 'config': 'Resolving the configuration failed, see output above' }
+  except Exception as e:
+    errors = { 'config': 'Resolving the configuration failed: %s' % e }
+
+  return kind, name, errors, time.time() - start_time
+
+
+def validate_all_configurations(workers=False):
+  """Resolves and validates all hosts and dockerHosts using a pool of processes.
+
+  Returns a report with the errors and the resolution time per configuration.
+  """
+  global lockfile_ignore
+
+  start_time = time.time()
+  reset_configuration()
+  lockfile_ignore = True
+  try:
+    settings = getAll()
+  finally:
+    lockfile_ignore = False
+
+  # Fetch remote resources before forking, so every worker inherits them.
+  references = []
+  for name in settings['hosts'].keys():
+    references += get_remote_references(settings['hosts'][name], settings['hosts'])
+  prefetch_remote_configurations(references)
+
+  jobs = [ ('hosts', name) for name in sorted(settings['hosts'].keys()) ]
+  jobs += [ ('dockerHosts', name) for name in sorted(settings['dockerHosts'].keys()) ]
+
+  report = { 'hosts': {}, 'dockerHosts': {}, 'valid': True }
+  if jobs:
+    import multiprocessing
+    pool = multiprocessing.Pool(workers or None)
+    try:
+      results = pool.map(validate_worker, jobs, 1)
+    finally:
+      pool.terminate()
+
+    for kind, name, errors, duration in results:
+      report[kind][name] = { 'errors': errors, 'time': duration }
+      if errors:
+        report['valid'] = False
+
+  report['time'] = time.time() - start_time
+
+  return report
+
+
 def find_configfiles(candidates, max_levels):
   global fabfile_basedir
 
@@ -106,60 +532,112 @@ def find_configfiles(candidates, max_levels):
 
 
 def data_merge(a, b):
-  output = {}
-  for item, value in a.iteritems():
-    if b.has_key(item):
-      if isinstance(b[item], dict):
-        output[item] = data_merge(value, b.pop(item))
-    else:
-      output[item] = copy.deepcopy(value)
+  """Merges b into a without modifying any of them.
+
+  Dicts present in both inputs are merged into new dicts, all other values
+  are not copied and shared with a and b. Callers changing merged data in
+  place have to copy it first, like get_configuration does for
+  host-configurations.
+  """
+  output = dict(a)
   for item, value in b.iteritems():
-    output[item] = copy.deepcopy(value)
+    if isinstance(value, dict) and isinstance(output.get(item), dict):
+      output[item] = data_merge(output[item], value)
+    else:
+      output[item] = value
   return output
 
 
-def resolve_inheritance(config, all_configs):
-  if not config or 'inheritsFrom' not in config:
-    return config
+class InheritanceResolver(object):
+  """Resolves inheritsFrom against a set of configurations.
 
-  inherits_from = config['inheritsFrom']
-  config.pop('inheritsFrom', None)
+  Every base-configuration is fetched and resolved only once, the merged result
+  is cached and shared between all configurations inheriting from it.
+  """
 
-  if not isinstance(inherits_from, basestring):
-    for item in reversed(inherits_from):
-      config['inheritsFrom'] = item
-      config = resolve_inheritance_impl(config, all_configs)
+  def __init__(self, all_configs):
+    self.all_configs = all_configs
+    self.resolved = {}
+    self.stack = []
 
-    return config
+  def clear(self):
+    self.resolved = {}
 
-  else:
-    config['inheritsFrom'] = inherits_from
-    return resolve_inheritance_impl(config, all_configs)
+  def fetch(self, reference):
+    if is_remote_reference(reference):
+      return get_remote_configuration(reference)
+
+    elif reference[0:1] == '.' or reference[0:1] == '/':
+      return get_configuration_via_file(reference)
+
+    elif reference in self.all_configs:
+      return self.all_configs[reference]
+
+    return False
+
+  def get_base(self, reference):
+    if reference in self.stack:
+      chain = self.stack[self.stack.index(reference):] + [reference]
+      print red('Found circular inheritance: %s' % ' -> '.join(chain))
+      exit(1)
+
+    if reference not in self.resolved:
+      self.stack.append(reference)
+      try:
+        base_config = self.fetch(reference)
+        # Resolving sets inheritsFrom, keep the fetched data intact.
+        if isinstance(base_config, dict):
+          base_config = dict(base_config)
+        self.resolved[reference] = self.resolve(base_config)
+      finally:
+        self.stack.pop()
 
+    return self.resolved[reference]
+
+  def resolve(self, config, name=False):
+    if not config or 'inheritsFrom' not in config:
+      return config
+
+    inherits_from = config['inheritsFrom']
+    if isinstance(inherits_from, basestring):
+      inherits_from = [ inherits_from ]
+
+    if name:
+      self.stack.append(name)
+
+    try:
+      for item in reversed(inherits_from):
+        config['inheritsFrom'] = item
+        base_config = self.get_base(item)
+        if base_config:
+          config = data_merge(base_config, config)
+    finally:
+      if name:
+        self.stack.pop()
 
-def resolve_inheritance_impl(config, all_configs):
-  if 'inheritsFrom' not in config:
     return config
 
-  inherits_from = config['inheritsFrom']
-  base_config = False
 
-  if inherits_from[0:7] == 'http://' or inherits_from[0:8] == 'https://':
-    base_config = get_configuration_via_http(inherits_from)
+# Resolvers keyed by the identity of the configurations they resolve against.
+inheritance_resolvers = []
 
-  elif inherits_from[0:1] == '.' or inherits_from[0:1] == '/':
-    base_config = get_configuration_via_file(inherits_from)
+def get_inheritance_resolver(all_configs):
+  for configs, resolver in inheritance_resolvers:
+    if configs is all_configs:
+      return resolver
 
-  elif inherits_from in all_configs:
-    base_config = copy.deepcopy(all_configs[inherits_from])
+  resolver = InheritanceResolver(all_configs)
+  inheritance_resolvers.append((all_configs, resolver))
+  return resolver
 
-  if base_config and 'inheritsFrom' in base_config:
-    base_config = resolve_inheritance(base_config, all_configs)
 
-  if base_config:
-    config = data_merge(base_config, config)
+def resolve_inheritance(config, all_configs, name=False):
+  return get_inheritance_resolver(all_configs).resolve(config, name)
+
+
+def resolve_reference(reference, all_configs):
+  return get_inheritance_resolver(all_configs).get_base(reference)
 
-  return config
 
 def versiontuple(v):
   return tuple(map(int, (v.split("."))))
@@ -174,7 +652,7 @@ def check_fabalicious_version(required_version, msg):
     print red('You are currently using %s. Please update your fabalicious installation.' % current_version)
     exit(1)
 
-def validate_config_against_methods(config):
+def get_config_errors(config):
   from lib import methods
 
   errors = validate_dict(['rootFolder', 'type', 'needs'], config)
@@ -184,10 +662,16 @@ def validate_config_against_methods(config):
     e = m.validateConfig(config)
     errors = data_merge(errors, e)
 
-  if len(errors) > 0:
-    for key, msg in errors.iteritems():
-      print red('Key \'%s\' in %s: %s' % (key, config['config_name'], msg))
+  return errors
 
+def print_config_errors(errors, config_name):
+  for key, msg in errors.iteritems():
+    print red('Key \'%s\' in %s: %s' % (key, config_name, msg))
+
+def validate_config_against_methods(config):
+  errors = get_config_errors(config)
+  if len(errors) > 0:
+    print_config_errors(errors, config['config_name'])
     exit(1)
 
 def get_default_config_from_methods(config, settings, defaults):
@@ -209,74 +693,124 @@ def apply_config_by_methods(config, settings):
     m.applyConfig(config, settings)
 
 
-def get_configuration(name):
-  unsupported = {
-    'needsComposer': '"%s" is unsupported, please add "composer" to your "needs" ',
-    'hasDrush': '"%s" is unsupported, please add "drush7" or "drush8" to your "needs"',
-    'supportsSSH': '"%s" is unsupported, please add "ssh" to your "needs"',
-    'useForDevelopment': '"%s" is unsupported, please use "type" with "dev|prod|stage" as value.'
-  }
+def build_configuration(name):
+  """Resolves and validates the host-configuration name and applies all defaults.
+
+  Returns the configuration and the validation errors. If there are errors
+  the returned configuration is resolved, but incomplete.
+  """
   config = getAll()
 
-  if name in config['hosts']:
-    host_config = copy.deepcopy(config['hosts'][name])
-    host_config = resolve_inheritance(host_config, config['hosts'])
+  # Fetch all remote resources the configuration depends on at once.
+  references = get_remote_references(config['hosts'][name], config['hosts'])
+  prefetch_remote_configurations(references)
+
+  host_config = resolve_inheritance(dict(config['hosts'][name]), config['hosts'], name)
+  # The resolved data shares its values with the base-configurations.
+  host_config = copy.deepcopy(host_config)
 
-    if 'requires' in host_config:
-      check_fabalicious_version(host_config['requires'], 'host-configuration ' + name)
+  if 'requires' in host_config:
+    check_fabalicious_version(host_config['requires'], 'host-configuration ' + name)
 
-    if 'needs' not in host_config:
-      host_config['needs'] = config['needs']
+  if 'needs' not in host_config:
+    host_config['needs'] = config['needs']
 
-    if 'runLocally' not in host_config:
-      host_config['runLocally'] = False
+  if 'runLocally' not in host_config:
+    host_config['runLocally'] = False
 
+  if 'script' not in config['needs']:
     config['needs'].append('script')
 
-    host_config['config_name'] = name
+  host_config['config_name'] = name
 
-    validate_config_against_methods(host_config)
+  errors = get_config_errors(host_config)
+  if len(errors) > 0:
+    return host_config, errors
+
+  # add defaults
+  defaults = {
+    'type': 'prod',
+    'supportsBackups': True,
+    'supportsCopyFrom': True,
+    'supportsInstalls': False,
+    'supportsZippedBackups': True,
+    'tmpFolder': '/tmp',
+    'scripts': {},
+    'executables': config['executables']
+  }
 
-    # add defaults
-    defaults = {
-      'type': 'prod',
-      'supportsBackups': True,
-      'supportsCopyFrom': True,
-      'supportsInstalls': False,
-      'supportsZippedBackups': True,
-      'tmpFolder': '/tmp',
-      'scripts': {},
-      'executables': config['executables']
-    }
+  defaults = get_default_config_from_methods(host_config, config, defaults)
 
-    defaults = get_default_config_from_methods(host_config, config, defaults)
+  for key in defaults:
+    if key not in host_config:
+      # Methods modify some defaults in place, e.g. the executables.
+      host_config[key] = copy.deepcopy(defaults[key])
 
-    for key in defaults:
-      if key not in host_config:
-        host_config[key] = defaults[key]
+  apply_config_by_methods(host_config, config)
 
-    apply_config_by_methods(host_config, config)
+  if 'database' in host_config:
+    if 'host' not in host_config['database']:
+      host_config['database']['host'] = 'localhost'
 
-    if 'database' in host_config:
-      if 'host' not in host_config['database']:
-        host_config['database']['host'] = 'localhost'
+  if not 'backupBeforeDeploy' in host_config:
+    host_config['backupBeforeDeploy'] = host_config['type'] != 'dev' and host_config['type'] != 'test'
 
-    if not 'backupBeforeDeploy' in host_config:
-      host_config['backupBeforeDeploy'] = host_config['type'] != 'dev' and host_config['type'] != 'test'
+  return host_config, {}
 
 
+def get_configuration(name):
+  unsupported = {
+    'needsComposer': '"%s" is unsupported, please add "composer" to your "needs" ',
+    'hasDrush': '"%s" is unsupported, please add "drush7" or "drush8" to your "needs"',
+    'supportsSSH': '"%s" is unsupported, please add "ssh" to your "needs"',
+    'useForDevelopment': '"%s" is unsupported, please use "type" with "dev|prod|stage" as value.'
+  }
+  config = getAll()
+
+  if name in locked_names['hosts']:
+    if name in lockfile_data['errors']:
+      print_config_errors(lockfile_data['errors'][name], name)
+      exit(1)
+
+    return apply_tunnel_port(copy.deepcopy(config['hosts'][name]))
 
+  if name in config['hosts']:
+    key = (name, host_configurations_generation)
+    if key in host_configurations:
+      host_configurations_stats['hits'] += 1
+      return apply_tunnel_port(copy.deepcopy(host_configurations[key]))
+
+    host_configurations_stats['misses'] += 1
+    host_config, errors = build_configuration(name)
+    if len(errors) > 0:
+      print_config_errors(errors, name)
+      exit(1)
 
     for key in unsupported:
       if key in host_config:
         print red(unsupported[key] % key)
 
-    return host_config
+    # Callers may modify their configuration, the built one shares values with
+    # the settings, e.g. merged gitOptions.
+    host_configurations[(name, host_configurations_generation)] = host_config
+    return apply_tunnel_port(copy.deepcopy(host_config))
 
   print(red('Configuraton '+name+' not found \n'))
   list()
   exit(1)
 
+def apply_tunnel_port(config):
+  if not isinstance(config.get('sshTunnel'), dict) or 'port' in config or 'localPort' in config['sshTunnel']:
+    return config
+
+  name = config['config_name']
+  if name not in tunnel_ports:
+    tunnel_ports[name] = allocate_port()
+
+  config['port'] = tunnel_ports[name]
+  config['sshTunnel']['localPort'] = tunnel_ports[name]
+  return config
+
 def get_configuration_via_file(config_file_name):
   global fabfile_basedir
   candidates = []
@@ -298,48 +832,115 @@ def get_configuration_via_file(config_file_name):
 
   data = False
   # print "Reading configuration from %s" % found
+  track_config_input(found)
   try:
     stream = open(found, 'r')
-    data = yaml.load(stream)
+    data = yaml_load(stream)
   except IOError:
     print red("could not read configuration from %s" % found)
 
   return data
 
-def remote_config_cache_get_filename(config_file_name):
+def get_cache_filename(key, extension):
   m = hashlib.md5()
-  m.update(config_file_name);
-  filename = os.path.expanduser("~") + "/.fabalicious/" + m.hexdigest() + '.yaml'
+  m.update(key);
+  filename = os.path.expanduser("~") + "/.fabalicious/" + m.hexdigest() + extension
   if not os.path.exists(os.path.dirname(filename)):
-    os.makedirs(os.path.dirname(filename))
+    try:
+      os.makedirs(os.path.dirname(filename))
+    except OSError:
+      # Another thread might have created it in the meantime.
+      if not os.path.isdir(os.path.dirname(filename)):
+        raise
 
   return filename
 
-def remote_config_cache_save(config_file_name, data):
+def remote_config_cache_get_filename(config_file_name):
+  return get_cache_filename(config_file_name, '.yaml')
+
+def remote_config_cache_save(config_file_name, data, headers=False):
   filename = remote_config_cache_get_filename(config_file_name)
   stream = open(filename, 'w')
-  yaml.dump(data, stream, default_flow_style=False)
+  yaml_dump(data, stream, default_flow_style=False)
+
+  meta = {
+    'url': config_file_name,
+    'fetched': time.time(),
+    'etag': headers.getheader('ETag') if headers else None,
+    'lastModified': headers.getheader('Last-Modified') if headers else None
+  }
+  remote_config_cache_save_meta(config_file_name, meta)
 
 def remote_config_cache_load(config_file_name):
   try:
     filename = remote_config_cache_get_filename(config_file_name)
     stream = open(filename, 'r')
-    data = yaml.load(stream)
+    data = yaml_load(stream)
     return data
   except:
     return False
 
+def remote_config_cache_save_meta(config_file_name, meta):
+  try:
+    with open(get_cache_filename(config_file_name, '.meta'), 'w') as stream:
+      json.dump(meta, stream)
+  except IOError:
+    pass
+
+def remote_config_cache_load_meta(config_file_name):
+  try:
+    with open(get_cache_filename(config_file_name, '.meta'), 'r') as stream:
+      return json.load(stream)
+  except (IOError, ValueError):
+    return False
+
+
+def remote_config_offline():
+  return env.get('offline', False)
+
+def remote_config_ttl():
+  return float(env.get('remoteConfigTTL', 0))
+
 
 def get_configuration_via_http(config_file_name):
+  # Imported on demand, most runs never fetch remote configurations.
+  import urllib2
+  global config_cacheable
+  config_cacheable = False
+
+  meta = remote_config_cache_load_meta(config_file_name)
+
+  # Skip the network if the cached data is fresh enough or we are offline.
+  if meta and (remote_config_offline() or time.time() - meta['fetched'] < remote_config_ttl()):
+    data = remote_config_cache_load(config_file_name)
+    if data:
+      return data
+
+  if remote_config_offline():
+    print red('Could not find cached configuration for %s, needed in offline-mode' % config_file_name)
+    return False
+
+  request = urllib2.Request(config_file_name)
+  if meta and meta['etag']:
+    request.add_header('If-None-Match', meta['etag'])
+  if meta and meta['lastModified']:
+    request.add_header('If-Modified-Since', meta['lastModified'])
+
   try:
     # print "Reading configuration from %s" % config_file_name
-    response = urllib2.urlopen(config_file_name)
+    response = urllib2.urlopen(request, timeout=remote_config_timeout)
     html = response.read()
-    data = yaml.load(html)
-    remote_config_cache_save(config_file_name, data)
-    return yaml.load(html)
-  except (urllib2.URLError, urllib2.HTTPError) as err:
+    data = yaml_load(html)
+    remote_config_cache_save(config_file_name, data, response.info())
+    return data
+  except (urllib2.URLError, socket.error) as err:
     data = remote_config_cache_load(config_file_name)
+
+    if data and isinstance(err, urllib2.HTTPError) and err.code == 304:
+      meta['fetched'] = time.time()
+      remote_config_cache_save_meta(config_file_name, meta)
+      return data
+
     if data:
       print yellow('Could not read configuration from %s, using cached data.' % config_file_name)
       return data
@@ -349,6 +950,69 @@ def get_configuration_via_http(config_file_name):
   return False
 
 
+def is_remote_reference(reference):
+  return isinstance(reference, basestring) and (reference[0:7] == 'http://' or reference[0:8] == 'https://')
+
+
+def get_remote_configuration(url):
+  global config_cacheable
+  # Also memoized data can change remotely, never cache configurations using it.
+  config_cacheable = False
+
+  if url not in remote_configurations:
+    remote_configurations[url] = get_configuration_via_http(url)
+
+  return remote_configurations[url]
+
+
+def get_remote_references(config, all_configs, visited=None):
+  """Returns all remote locations config and its local base-configurations refer to."""
+  visited = visited if visited is not None else set()
+  result = []
+  if not isinstance(config, dict):
+    return result
+
+  if isinstance(config.get('docker'), dict) and is_remote_reference(config['docker'].get('configuration')):
+    result.append(config['docker']['configuration'])
+
+  inherits_from = config.get('inheritsFrom', [])
+  if isinstance(inherits_from, basestring):
+    inherits_from = [ inherits_from ]
+
+  for reference in inherits_from:
+    if is_remote_reference(reference):
+      result.append(reference)
+    elif reference not in visited and reference in all_configs:
+      visited.add(reference)
+      result += get_remote_references(all_configs[reference], all_configs, visited)
+
+  return result
+
+
+def prefetch_remote_configurations(references):
+  """Fetches remote configurations concurrently, including the ones they refer to."""
+  pending = [ url for url in set(references) if url not in remote_configurations ]
+
+  while pending:
+    if len(pending) == 1:
+      results = [ get_configuration_via_http(pending[0]) ]
+    else:
+      from multiprocessing.pool import ThreadPool
+      pool = ThreadPool(min(len(pending), remote_config_workers))
+      try:
+        results = pool.map(get_configuration_via_http, pending)
+      finally:
+        pool.close()
+        pool.join()
+
+    found = []
+    for url, data in zip(pending, results):
+      remote_configurations[url] = data
+      found += get_remote_references(data, {})
+
+    pending = [ url for url in set(found) if url not in remote_configurations ]
+
+
 def apply(config, name):
 
   env.config = config
@@ -406,10 +1070,17 @@ def current(key = False):
   else:
     return env.config
 
+def clear_host_configurations():
+  global host_configurations, host_configurations_generation
+
+  host_configurations = {}
+  host_configurations_generation += 1
+
 def getAll():
   global root_data
 
   if not root_data:
+    clear_host_configurations()
     root_data = get_all_configurations()
 
     if not 'common' in root_data:
@@ -481,6 +1152,23 @@ def getBaseDir():
   return fabfile_basedir
 
 
+def build_docker_configuration(docker_config_name, runLocally = False):
+  dockerHosts = getAll()['dockerHosts']
+
+  docker_config = dockerHosts[docker_config_name]
+  if docker_config_name not in locked_names['dockerHosts']:
+    docker_config = resolve_inheritance(dict(docker_config), dockerHosts, docker_config_name)
+  docker_config = copy.deepcopy(docker_config)
+
+  if 'runLocally' in docker_config and docker_config['runLocally'] or runLocally:
+    keys = ['rootFolder', 'tasks']
+  else:
+    docker_config['runLocally'] = False
+    keys = ['tasks', 'rootFolder', 'user', 'host', 'port']
+
+  return docker_config, validate_dict(keys, docker_config)
+
+
 def getDockerConfig(docker_config_name, runLocally = False, printErrors=True):
 
   settings = getAll()
@@ -493,16 +1181,7 @@ def getDockerConfig(docker_config_name, runLocally = False, printErrors=True):
   if not dockerHosts or docker_config_name not in dockerHosts:
     return False
 
-  docker_config = copy.deepcopy(dockerHosts[docker_config_name])
-  docker_config = resolve_inheritance(docker_config, dockerHosts)
-
-  if 'runLocally' in docker_config and docker_config['runLocally'] or runLocally:
-    keys = ['rootFolder', 'tasks']
-  else:
-    docker_config['runLocally'] = False
-    keys = ['tasks', 'rootFolder', 'user', 'host', 'port']
-
-  errors = validate_dict(keys, docker_config)
+  docker_config, errors = build_docker_configuration(docker_config_name, runLocally)
   if len(errors) > 0:
     if printErrors:
       for key in errors:
@@ -516,3 +1195,6 @@ def getDockerConfig(docker_config_name, runLocally = False, printErrors=True):
 def add(config_name, config):
   settings = getAll()
   settings['hosts'][config_name] = config
+  locked_names['hosts'].discard(config_name)
+  get_inheritance_resolver(settings['hosts']).clear()
+  clear_host_configurations()
@@ -0,0 +1,225 @@
+import atexit
+import json
+import os.path
+import pipes
+import time
+from fabric import api
+from fabric.colors import yellow
+from fabric.operations import _AttributeString, _AttributeList
+from fabric.state import env
+from lib import statcache
+from lib import tracing
+
+# All commands and file-transfers go through the backend returned by
+# get_backend(). Use `fab --set plan` to record them instead of running them,
+# `fab --set plan=<file>` additionally writes the recorded plan as json.
+
+backend = False
+
+# Bytes transferred with put and get.
+stats = { 'bytes': 0 }
+
+
+def count_bytes(paths):
+  for path in paths:
+    if isinstance(path, basestring) and os.path.isfile(path):
+      stats['bytes'] += os.path.getsize(path)
+
+
+class FabricBackend(object):
+  """Runs everything via fabric."""
+
+  recording = False
+
+  def run(self, cmd, **kwargs):
+    return api.run(cmd, **kwargs)
+
+  def sudo(self, cmd, **kwargs):
+    return api.sudo(cmd, **kwargs)
+
+  def local(self, cmd, **kwargs):
+    return api.local(cmd, **kwargs)
+
+  def put(self, *args, **kwargs):
+    result = api.put(*args, **kwargs)
+    count_bytes([ kwargs['local_path'] if 'local_path' in kwargs else args[0] ])
+    return result
+
+  def get(self, *args, **kwargs):
+    result = api.get(*args, **kwargs)
+    count_bytes(result)
+    return result
+
+  def exists(self, path, **kwargs):
+    from fabric.contrib import files
+    return files.exists(path, **kwargs)
+
+  def record(self, type, **kwargs):
+    pass
+
+
+class RecordingBackend(object):
+  """Records all commands and file-transfers without touching any host."""
+
+  recording = True
+
+  def __init__(self, filename=False, verbose=True):
+    self.filename = filename
+    self.verbose = verbose
+    self.entries = []
+    self.start_time = time.time()
+    atexit.register(self.finish)
+
+  def record(self, type, **kwargs):
+    entry = {
+      'type': type,
+      'host': env.host_string,
+      'time': time.time() - self.start_time
+    }
+    entry.update(kwargs)
+    self.entries.append(entry)
+
+    if self.verbose:
+      print yellow('[plan] %d: %s' % (len(self.entries), self.describe(entry)))
+    return entry
+
+  def describe(self, entry):
+    if entry['type'] in ['run', 'sudo', 'local']:
+      where = 'local' if entry['type'] == 'local' else entry['host']
+      cwd = ' in %s' % entry['cwd'] if entry['cwd'] else ''
+      environment = ' with %s' % ' '.join('%s=%s' % item for item in sorted(entry['env'].items())) if entry['env'] else ''
+      return '%s on %s%s%s: %s' % (entry['type'], where, cwd, environment, entry['command'])
+    elif entry['type'] in ['put', 'get']:
+      return '%s %s -> %s on %s' % (entry['type'], entry['source'], entry['target'], entry['host'])
+
+    details = dict((key, value) for key, value in entry.iteritems() if key not in ['type', 'time'])
+    return '%s %s' % (entry['type'], ', '.join('%s=%s' % item for item in sorted(details.items())))
+
+  def result(self, command):
+    # Callers parse the output of some commands, give them something to work with.
+    result = _AttributeString('planned')
+    result.command = command
+    result.real_command = command
+    result.failed = False
+    result.succeeded = True
+    result.return_code = 0
+    result.stderr = ''
+    return result
+
+  def command(self, type, cmd, cwd):
+    self.record(type, command=cmd, cwd=cwd, env=dict(env.shell_env))
+    return self.result(cmd)
+
+  def run(self, cmd, **kwargs):
+    return self.command('run', cmd, env.cwd)
+
+  def sudo(self, cmd, **kwargs):
+    return self.command('sudo', cmd, env.cwd)
+
+  def local(self, cmd, **kwargs):
+    return self.command('local', cmd, env.lcwd)
+
+  def transfer(self, type, source, target):
+    self.record(type, source=source, target=target)
+    result = _AttributeList([ target ])
+    result.failed = []
+    result.succeeded = True
+    return result
+
+  def put(self, local_path=None, remote_path=None, **kwargs):
+    return self.transfer('put', local_path, remote_path)
+
+  def get(self, remote_path, local_path=None, **kwargs):
+    return self.transfer('get', remote_path, local_path)
+
+  def exists(self, path, **kwargs):
+    # Nothing exists on hosts we never touch.
+    self.record('exists', path=path, result=False)
+    return False
+
+  def finish(self):
+    if not self.verbose:
+      return
+
+    print yellow('[plan] %d commands and file-transfers recorded in %.3fs.' % (len(self.entries), time.time() - self.start_time))
+
+    if self.filename:
+      with open(self.filename, 'w') as stream:
+        json.dump(self.entries, stream, indent=2, sort_keys=True)
+      print yellow('[plan] Written to %s' % self.filename)
+
+
+def get_backend():
+  global backend
+
+  if not backend:
+    plan = env.get('plan', False)
+    if plan:
+      backend = RecordingBackend(plan if isinstance(plan, basestring) else False)
+    else:
+      backend = FabricBackend()
+
+  return backend
+
+def set_backend(new_backend):
+  global backend
+  backend = new_backend
+
+def is_recording():
+  return get_backend().recording
+
+def record(type, **kwargs):
+  return get_backend().record(type, **kwargs)
+
+def get_entries():
+  return get_backend().entries if is_recording() else []
+
+def reset():
+  """Forgets all recorded entries, e.g. in a forked process which reports its entries to the parent."""
+  del get_entries()[:]
+
+def merge(entries):
+  get_entries().extend(entries)
+
+
+def traced(type, cmd, fn, *args, **kwargs):
+  if not tracing.enabled():
+    return fn(*args, **kwargs)
+
+  with tracing.span(type, 'command', command=cmd) as span:
+    result = fn(*args, **kwargs)
+    if hasattr(result, 'return_code'):
+      span.set(exitCode=result.return_code)
+    return result
+
+
+def changing(cmd, fn, *args, **kwargs):
+  """Runs a command on the current host and invalidates the paths it changes in the stat-cache."""
+  try:
+    return fn(*args, **kwargs)
+  finally:
+    if not is_recording():
+      statcache.invalidate_command(cmd)
+
+
+def run(cmd, **kwargs):
+  return changing(cmd, traced, 'run', cmd, get_backend().run, cmd, **kwargs)
+
+def sudo(cmd, **kwargs):
+  return changing(cmd, traced, 'sudo', cmd, get_backend().sudo, cmd, **kwargs)
+
+def local(cmd, **kwargs):
+  return traced('local', cmd, get_backend().local, cmd, **kwargs)
+
+def put(*args, **kwargs):
+  remote_path = kwargs['remote_path'] if 'remote_path' in kwargs else args[1] if len(args) > 1 else ''
+  return changing('touch ' + pipes.quote(remote_path), traced, 'put', args or kwargs, get_backend().put, *args, **kwargs)
+
+def get(*args, **kwargs):
+  return traced('get', args or kwargs, get_backend().get, *args, **kwargs)
+
+def exists(path, **kwargs):
+  # Checks with options like use_sudo are not cached.
+  if kwargs or is_recording():
+    return traced('exists', path, get_backend().exists, path, **kwargs)
+  return statcache.exists(path)
@@ -0,0 +1,182 @@
+import fnmatch
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import traceback
+from fabric.api import env, execute
+from fabric.colors import green, red, yellow
+from fabric.network import disconnect_all
+from fabric.state import connections
+from lib import configuration
+from lib import executor
+from lib import history
+from lib import sshmux
+from lib import tracing
+
+
+def get_host_names(patterns=False, tag=False):
+  """Returns the names of all host-configurations matching one of the glob-patterns or having the tag."""
+  hosts = configuration.getAll()['hosts']
+  names = sorted(hosts.keys())
+
+  if patterns:
+    patterns = patterns.split(';')
+    names = [ name for name in names if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns) ]
+
+  if tag:
+    tagged = []
+    for name in names:
+      config = configuration.resolve_inheritance(dict(hosts[name]), hosts, name)
+      if tag in config.get('tags', []):
+        tagged.append(name)
+    names = tagged
+
+  return names
+
+
+def prefix_output(fd, prefix, target):
+  # Lines are written in one go, so lines of different workers do not mix.
+  stream = os.fdopen(fd, 'r', 0)
+  for line in iter(stream.readline, ''):
+    os.write(target, prefix + line)
+  stream.close()
+
+
+def run_worker(name, task, kwargs, pipe):
+  # Send everything written to stdout and stderr, including the output of
+  # subprocesses, through a pipe and prefix it with the configuration-name.
+  target = os.dup(1)
+  read_fd, write_fd = os.pipe()
+  os.dup2(write_fd, 1)
+  os.dup2(write_fd, 2)
+  os.close(write_fd)
+  reader = threading.Thread(target=prefix_output, args=(read_fd, '[%s] ' % name, target))
+  reader.start()
+
+  # Every worker runs in its own process, env.config and the connections of
+  # the parent are not shared.
+  connections.clear()
+  tracing.reset()
+  history.reset()
+  executor.reset()
+  exit_code = 0
+  try:
+    with tracing.span(name, 'configuration'):
+      config = configuration.get(name)
+      configuration.apply(config, name)
+      execute(task, **kwargs)
+  except SystemExit as e:
+    if e.code is None:
+      exit_code = 0
+    else:
+      exit_code = e.code if isinstance(e.code, int) else 1
+  except:
+    traceback.print_exc()
+    exit_code = 1
+  finally:
+    try:
+      disconnect_all()
+    except:
+      pass
+    history.flush()
+    # Report the spans and the planned commands of this worker back to the parent.
+    pipe.send((tracing.spans, executor.get_entries()))
+    pipe.close()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    reader.join()
+
+  sys.exit(exit_code)
+
+
+def run(names, task, kwargs, workers=4, on_failure='continue'):
+  """Runs the fabric-task on all host-configurations using a pool of processes.
+
+  Returns a dict with the status, exit-code and duration per configuration.
+  """
+  if on_failure not in ['continue', 'abort']:
+    print red('Unknown value "%s" for onFailure, use "continue" or "abort".' % on_failure)
+    exit(1)
+
+  # Resolve all configurations before forking, so the workers inherit them.
+  for name in names:
+    configuration.get(name)
+
+  # Workers share the folder of the ssh control-sockets, this process closes them.
+  if sshmux.enabled():
+    sshmux.get_folder()
+
+  # Workers report their planned commands to the backend of this process.
+  executor.get_backend()
+
+  results = dict((name, { 'status': 'skipped', 'exitCode': False, 'time': 0 }) for name in names)
+  pending = list(names)
+  running = {}
+
+  sys.stdout.flush()
+  with tracing.span('fleet', 'task', configurations=names):
+    schedule(pending, running, results, task, kwargs, workers, on_failure)
+
+  return results
+
+
+def receive_report(pipe):
+  try:
+    if pipe.poll():
+      spans, entries = pipe.recv()
+      tracing.merge(spans)
+      executor.merge(entries)
+  except (EOFError, IOError):
+    pass
+
+
+def schedule(pending, running, results, task, kwargs, workers, on_failure):
+  aborted = False
+  while running or (pending and not aborted):
+    while pending and not aborted and len(running) < workers:
+      name = pending.pop(0)
+      parent_pipe, child_pipe = multiprocessing.Pipe(False)
+      process = multiprocessing.Process(target=run_worker, args=(name, task, kwargs, child_pipe))
+      process.start()
+      child_pipe.close()
+      running[name] = (process, parent_pipe, time.time())
+
+    time.sleep(0.05)
+    for name, (process, pipe, start_time) in running.items():
+      # Read the report while the worker is alive, it blocks on sending large amounts.
+      alive = process.is_alive()
+      receive_report(pipe)
+      if alive:
+        continue
+
+      process.join()
+      pipe.close()
+      del running[name]
+      results[name] = {
+        'status': 'ok' if process.exitcode == 0 else 'failed',
+        'exitCode': process.exitcode,
+        'time': time.time() - start_time
+      }
+      if process.exitcode != 0 and on_failure == 'abort':
+        aborted = True
+
+
+def print_summary(names, results):
+  width = max([ len(name) for name in names ] + [ len('Configuration') ])
+  print
+  print '%s  %-7s  %9s  %9s' % ('Configuration'.ljust(width), 'Status', 'Exit-code', 'Duration')
+  for name in names:
+    result = results[name]
+    exit_code = '-' if result['exitCode'] is False else str(result['exitCode'])
+    line = '%s  %-7s  %9s  %8.1fs' % (name.ljust(width), result['status'], exit_code, result['time'])
+    if result['status'] == 'ok':
+      print green(line)
+    elif result['status'] == 'failed':
+      print red(line)
+    else:
+      print yellow(line)
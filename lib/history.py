@@ -0,0 +1,315 @@
+import atexit
+import functools
+import os
+import os.path
+import Queue
+import threading
+import time
+from fabric.colors import red, yellow
+from fabric.state import env
+
+# Records every invocation of a fabfile-task into a local sqlite-database, see
+# the `stats`-task. Records are written by a background-thread in batches, so
+# the task itself never waits for the database. Disable it with
+# `fab --set noHistory`.
+
+SCHEMA = [
+  '''CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    task TEXT NOT NULL,
+    config_name TEXT,
+    version TEXT,
+    started REAL NOT NULL,
+    duration REAL NOT NULL,
+    exit_code INTEGER NOT NULL,
+    -- Transferred with put and get, transfers by rsync and scp are not counted.
+    bytes INTEGER NOT NULL DEFAULT 0
+  )''',
+  'CREATE INDEX IF NOT EXISTS runs_task ON runs (config_name, task, started)',
+  '''CREATE TABLE IF NOT EXISTS phases (
+    run_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    duration REAL NOT NULL
+  )''',
+]
+
+# The currently running task, nested tasks are part of it.
+current = False
+
+# Nesting depth of the running fabfile-tasks and the callbacks to run when the
+# outermost one is done.
+depth = 0
+deferred = []
+
+writer = False
+
+
+def get_filename():
+  return os.path.expanduser('~/.fabalicious/history.sqlite')
+
+
+def connect(filename):
+  import sqlite3
+
+  folder = os.path.dirname(filename)
+  if not os.path.exists(folder):
+    try:
+      os.makedirs(folder)
+    except OSError:
+      pass
+
+  connection = sqlite3.connect(filename, timeout=30)
+  for statement in SCHEMA:
+    connection.execute(statement)
+  return connection
+
+
+class Writer(threading.Thread):
+  """Writes finished runs to the database, all runs queued in the meantime in one transaction."""
+
+  def __init__(self, filename):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.filename = filename
+    self.queue = Queue.Queue()
+    self.pid = os.getpid()
+
+  def run(self):
+    connection = False
+    finished = False
+    while not finished:
+      batch = [ self.queue.get() ]
+      while True:
+        try:
+          batch.append(self.queue.get_nowait())
+        except Queue.Empty:
+          break
+
+      if None in batch:
+        finished = True
+        batch = [ record for record in batch if record ]
+
+      if not batch:
+        continue
+
+      try:
+        if not connection:
+          connection = connect(self.filename)
+        with connection:
+          for record in batch:
+            self.write(connection, record)
+      except Exception as e:
+        print red('Could not write run-history to %s: %s' % (self.filename, e))
+
+    if connection:
+      connection.close()
+
+  def write(self, connection, record):
+    cursor = connection.execute(
+      'INSERT INTO runs (task, config_name, version, started, duration, exit_code, bytes) VALUES (?, ?, ?, ?, ?, ?, ?)',
+      (record['task'], record['config_name'], record['version'], record['started'], record['duration'], record['exit_code'], record['bytes'])
+    )
+    connection.executemany(
+      'INSERT INTO phases (run_id, name, duration) VALUES (?, ?, ?)',
+      [ (cursor.lastrowid, name, duration) for name, duration in record['phases'] ]
+    )
+
+  def stop(self, timeout=10):
+    self.queue.put(None)
+    self.join(timeout)
+
+
+def get_writer():
+  global writer
+
+  # Threads do not survive a fork, every process needs its own writer.
+  if not writer or writer.pid != os.getpid():
+    if not writer:
+      atexit.register(flush)
+    writer = Writer(get_filename())
+    writer.start()
+
+  return writer
+
+
+def flush():
+  """Waits until all recorded runs are written."""
+  global writer
+
+  if writer and writer.pid == os.getpid() and writer.is_alive():
+    writer.stop()
+  writer = False
+
+
+def enabled():
+  # Planned runs do not run anything, their durations are meaningless.
+  return not env.get('noHistory', False) and not env.get('plan', False)
+
+
+def recorded(fn):
+  """Decorator for fabfile-tasks, records the invocation into the history.
+
+  Runs the deferred callbacks when the outermost task is done.
+  """
+
+  @functools.wraps(fn)
+  def wrapper(*args, **kwargs):
+    global depth
+
+    depth += 1
+    try:
+      return record_task(fn, args, kwargs)
+    finally:
+      depth -= 1
+      if not depth:
+        run_deferred()
+
+  return wrapper
+
+
+def record_task(fn, args, kwargs):
+  global current
+
+  if current is not False or not enabled():
+    return fn(*args, **kwargs)
+
+  from lib import executor
+
+  current = {
+    'task': fn.__name__,
+    'version': None,
+    'started': time.time(),
+    'phases': [],
+    'bytes': executor.stats['bytes']
+  }
+  exit_code = 0
+  try:
+    return fn(*args, **kwargs)
+  except SystemExit as e:
+    if e.code is not None:
+      exit_code = e.code if isinstance(e.code, int) else 1
+    raise
+  except:
+    exit_code = 1
+    raise
+  finally:
+    record = current
+    current = False
+    config = env.get('config', False)
+    record['config_name'] = config['config_name'] if config else None
+    record['duration'] = time.time() - record['started']
+    record['exit_code'] = exit_code
+    record['bytes'] = executor.stats['bytes'] - record['bytes']
+    get_writer().queue.put(record)
+
+
+def defer(fn, *args, **kwargs):
+  """Calls fn when the outermost running fabfile-task is done, right away without one."""
+  deferred.append((fn, args, kwargs))
+  if not depth:
+    run_deferred()
+
+
+def run_deferred():
+  while deferred:
+    fn, args, kwargs = deferred.pop(0)
+    fn(*args, **kwargs)
+
+
+def reset():
+  """Forgets the task of the parent-process, forked workers record their own tasks."""
+  global current
+  current = False
+
+
+def add_phase(name, duration):
+  if current is not False:
+    current['phases'].append((name, duration))
+
+
+def annotate(key, value):
+  if current is not False:
+    current[key] = value
+
+
+def percentile(values, percent):
+  values = sorted(values)
+  index = (len(values) - 1) * percent / 100.0
+  lower = int(index)
+  upper = min(lower + 1, len(values) - 1)
+  return values[lower] + (values[upper] - values[lower]) * (index - lower)
+
+
+def get_stats(task=False, config_name=False, recent=5, threshold=1.2):
+  """Returns duration-statistics per configuration and task of successful runs.
+
+  A task regressed, if the median of its last `recent` runs is more than
+  `threshold` times the median of the runs before.
+  """
+  filename = get_filename()
+  if not os.path.exists(filename):
+    return []
+
+  flush()
+  connection = connect(filename)
+  try:
+    query = 'SELECT config_name, task, duration FROM runs WHERE exit_code = 0'
+    params = []
+    if task:
+      query += ' AND task = ?'
+      params.append(task)
+    if config_name:
+      query += ' AND config_name = ?'
+      params.append(config_name)
+    query += ' ORDER BY started'
+
+    durations = {}
+    for row in connection.execute(query, params):
+      durations.setdefault((row[0], row[1]), []).append(row[2])
+
+    failures = dict(((row[0], row[1]), row[2]) for row in connection.execute(
+      'SELECT config_name, task, COUNT(*) FROM runs WHERE exit_code != 0 GROUP BY config_name, task'))
+  finally:
+    connection.close()
+
+  result = []
+  for key in sorted(durations.keys()):
+    values = durations[key]
+    entry = {
+      'config_name': key[0],
+      'task': key[1],
+      'runs': len(values),
+      'failed': failures.get(key, 0),
+      'p50': percentile(values, 50),
+      'p90': percentile(values, 90),
+      'max': max(values),
+      'last': values[-1],
+      'regression': False
+    }
+    if len(values) > recent:
+      before = percentile(values[:-recent], 50)
+      after = percentile(values[-recent:], 50)
+      if before > 0 and after / before > threshold:
+        entry['regression'] = after / before
+
+    result.append(entry)
+
+  return result
+
+
+def print_stats(stats):
+  if not stats:
+    print yellow('No runs recorded yet.')
+    return
+
+  width = max([ len(str(s['config_name'])) for s in stats ] + [ len('Configuration') ])
+  task_width = max([ len(s['task']) for s in stats ] + [ len('Task') ])
+  header = '%s  %s  %5s  %6s  %8s  %8s  %8s  %8s'
+  print header % ('Configuration'.ljust(width), 'Task'.ljust(task_width), 'Runs', 'Failed', 'p50', 'p90', 'Max', 'Last')
+  for s in stats:
+    line = '%s  %s  %5d  %6d  %7.1fs  %7.1fs  %7.1fs  %7.1fs' % (
+      str(s['config_name']).ljust(width), s['task'].ljust(task_width), s['runs'], s['failed'], s['p50'], s['p90'], s['max'], s['last'])
+    if s['regression']:
+      print red(line + '  %.1fx slower' % s['regression'])
+    else:
+      print line
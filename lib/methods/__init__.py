@@ -1,28 +1,48 @@
+import importlib
 import inspect, sys
-from fabric.colors import green, yellow
-
-from types import TypeType
-from base import BaseMethod
-from git import GitMethod
-from drush import DrushMethod
-from ssh import SSHMethod
-from composer import ComposerMethod
-from scripts import ScriptMethod
-from docker import DockerMethod
-from slack import SlackMethod
-from files import FilesMethod
-from drupalconsole import DrupalConsoleMethod
-from platform import PlatformMethod
+import time
+import multiprocessing
+import traceback
+from fabric.api import env
+from fabric.colors import green, red, yellow
+from fabric.state import connections
+from lib import executor
+from lib import history
+from lib import sshmux
+from lib import statcache
+from lib import tracing
+from base import BaseMethod, backup_manifests
+
+# Maps the method-names usable in `needs` to the module and class implementing
+# them. Modules get imported when a method is requested for the first time.
+registry = {
+  'ssh': ('ssh', 'SSHMethod'),
+  'git': ('git', 'GitMethod'),
+  'drush': ('drush', 'DrushMethod'),
+  'drush7': ('drush', 'DrushMethod'),
+  'drush8': ('drush', 'DrushMethod'),
+  'files': ('files', 'FilesMethod'),
+  'script': ('scripts', 'ScriptMethod'),
+  'composer': ('composer', 'ComposerMethod'),
+  'docker': ('docker', 'DockerMethod'),
+  'slack': ('slack', 'SlackMethod'),
+  'drupalconsole': ('drupalconsole', 'DrupalConsoleMethod'),
+  'platform': ('platform', 'PlatformMethod'),
+}
 
 cache = {}
 
+# Dispatch-tables keyed by the needs of a configuration, see get_dispatch_table.
+dispatch_tables = {}
+
 class Factory(object):
 
 
   @staticmethod
   def get(name):
-    methodClasses = [j for (i,j) in globals().iteritems() if isinstance(j, TypeType) and issubclass(j, BaseMethod)]
-    for methodClass in methodClasses:
+    if name in registry:
+      module_name, class_name = registry[name]
+      methodClass = getattr(importlib.import_module(__name__ + '.' + module_name), class_name)
       if methodClass.supports(name):
         return methodClass(name, sys.modules[__name__])
     #if research was unsuccessful, raise an error
@@ -50,21 +70,167 @@ def get(methodName, taskName):
   return False
 
 
-def callImpl(methodName, taskName, configuration, optional, **kwargs):
-  overrides = {}
-  for need in configuration['needs']:
-    override = getMethod(need).getOverrides()
-    if override:
-      overrides[override] = need
+def get_dispatch_table(needs):
+  """Returns the dispatch-table for a list of needs.
+
+  The table holds the overrides of the needs and all resolved callables,
+  entries get added on first use and are reused for the rest of the run.
+  """
+  key = tuple(needs)
+  if key not in dispatch_tables:
+    overrides = {}
+    for need in needs:
+      override = getMethod(need).getOverrides()
+      if override:
+        overrides[override] = need
+
+    dispatch_tables[key] = { 'needs': key, 'overrides': overrides, 'calls': {}, 'phases': {} }
+
+  return dispatch_tables[key]
+
+
+def resolve_call(table, methodName, taskName):
+  key = (methodName, taskName)
+  if key not in table['calls']:
+    override = table['overrides'].get(methodName, False)
+    table['calls'][key] = (override, get(override or methodName, taskName))
+
+  return table['calls'][key]
+
+
+def resolve_phase(table, taskName):
+  if taskName not in table['phases']:
+    phase = {
+      'calls': [],
+      'implemented': False,
+      'own': [],
+    }
+    for methodName in table['needs']:
+      phase['calls'].append(resolve_call(table, methodName, taskName))
+
+      # preflight, postflight and fallback are never overridden.
+      fn = get(methodName, taskName)
+      if fn:
+        phase['implemented'] = True
+        phase['own'].append(fn)
+
+    phase['groups'] = get_parallel_groups(phase['calls'], taskName)
+    table['phases'][taskName] = phase
+
+  return table['phases'][taskName]
+
+
+def get_parallel_groups(calls, taskName):
+  """Splits the calls of a task into groups which can run concurrently.
+
+  A call joins the current group, if its method declares the task as parallel
+  and none of its dependencies is part of the group. The order of the needs is
+  kept between groups.
+  """
+  groups = []
+  group = []
+  for override, fn in calls:
+    if not fn:
+      continue
+
+    dependencies = fn.im_self.parallelTasks.get(taskName, False)
+    if dependencies is False:
+      groups += [ group, [ fn ] ]
+      group = []
+    else:
+      for other in group:
+        if any(other.im_self.supports(dependency) for dependency in dependencies):
+          groups.append(group)
+          group = []
+          break
+      group.append(fn)
+
+  groups.append(group)
+
+  return [ group for group in groups if group ]
 
-  if methodName in overrides:
-    print "use override %s" % overrides[methodName]
-    methodName = overrides[methodName]
+
+def run_parallel_worker(fn, configuration, kwargs, pipe):
+  # The connections of the parent can't be shared, open new ones on demand.
+  connections.clear()
+  # Report only the spans of this process back to the parent.
+  tracing.reset()
+  lengths = dict((key, len(value)) for key, value in kwargs.iteritems() if isinstance(value, list))
+  try:
+    call_hook(fn, configuration, **kwargs)
+    changes = {}
+    for key, value in kwargs.iteritems():
+      if key in lengths:
+        changes[key] = value[lengths[key]:]
+      elif isinstance(value, dict):
+        changes[key] = value
+    pipe.send(('ok', changes, tracing.spans))
+  except SystemExit as e:
+    pipe.send(('exit', e.code, tracing.spans))
+  except:
+    pipe.send(('error', traceback.format_exc(), tracing.spans))
+  finally:
+    pipe.close()
+
+
+def run_parallel(fns, configuration, kwargs):
+  """Runs every fn in its own process and merges changes to list- and dict-kwargs back."""
+  # Workers share the folder of the ssh control-sockets, this process closes them.
+  if sshmux.enabled():
+    sshmux.get_folder()
+
+  workers = []
+  for fn in fns:
+    parent_pipe, child_pipe = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=run_parallel_worker, args=(fn, configuration, kwargs, child_pipe))
+    process.start()
+    child_pipe.close()
+    workers.append((fn, process, parent_pipe))
+
+  failed = False
+  for fn, process, pipe in workers:
+    try:
+      status, result, spans = pipe.recv()
+      tracing.merge(spans)
+    except EOFError:
+      status, result = 'error', 'process died unexpectedly'
+    process.join()
+
+    if status == 'ok':
+      for key, value in result.iteritems():
+        if isinstance(kwargs[key], list):
+          kwargs[key].extend(value)
+        else:
+          kwargs[key].update(value)
+    elif status == 'exit':
+      failed = failed or result or 1
+    else:
+      print red('%s.%s failed:\n%s' % (fn.im_class.__name__, fn.__name__, result))
+      failed = failed or 1
+
+  # The workers changed files and backup-manifests the caches of this process
+  # do not know about.
+  statcache.clear()
+  backup_manifests.clear()
+
+  if failed:
+    exit(failed)
+
+
+def call_hook(fn, *args, **kwargs):
+  with tracing.span('%s.%s' % (fn.im_class.__name__, fn.__name__), 'hook', method=fn.im_self.methodName):
+    return fn(*args, **kwargs)
+
+
+def callImpl(methodName, taskName, configuration, optional, **kwargs):
+  override, fn = resolve_call(get_dispatch_table(configuration['needs']), methodName, taskName)
+  if override:
+    print "use override %s" % override
+    methodName = override
 
   # print "calling %s@%s ..." % (methodName, taskName)
-  fn = get(methodName, taskName)
   if fn:
-    result = fn(configuration, **kwargs)
+    result = call_hook(fn, configuration, **kwargs)
     return result
   elif not optional:
     raise ValueError('Task "%s" in method "%s" not found!' % (taskName, methodName))
@@ -78,39 +244,66 @@ def call(methodName, taskName, configuration, **kwargs):
 
 
 def preflight(task, taskName, configuration, **kwargs):
-  for methodName in configuration['needs']:
-    fn = get(methodName, task)
-    if fn:
-      fn(taskName, configuration, **kwargs)
+  start_time = time.time()
+  with tracing.span('%s %s' % (taskName, task), 'phase'):
+    for fn in resolve_phase(get_dispatch_table(configuration['needs']), task)['own']:
+      call_hook(fn, taskName, configuration, **kwargs)
+  history.add_phase('%s %s' % (taskName, task), time.time() - start_time)
 
 
 
 def runTask(configuration, taskName, **kwargs):
-  preflight('preflight', taskName, configuration, **kwargs)
-  runTaskImpl(configuration['needs'], taskName + "Prepare", configuration, False, **kwargs);
-  runTaskImpl(configuration['needs'], taskName, configuration, True, **kwargs);
+  with tracing.span(taskName, 'task', config=configuration['config_name']):
+    preflight('preflight', taskName, configuration, **kwargs)
+    runTaskImpl(configuration['needs'], taskName + "Prepare", configuration, False, **kwargs);
+    runTaskImpl(configuration['needs'], taskName, configuration, True, **kwargs);
 
-  if 'nextTasks' in kwargs and len(kwargs['nextTasks']) > 0:
-    next_task = kwargs['nextTasks'].pop()
-    runTask(configuration, next_task, **kwargs)
+    if 'nextTasks' in kwargs and len(kwargs['nextTasks']) > 0:
+      next_task = kwargs['nextTasks'].pop()
+      runTask(configuration, next_task, **kwargs)
 
-  runTaskImpl(configuration['needs'], taskName + "Finished", configuration, False, **kwargs);
-  preflight('postflight', taskName, configuration, **kwargs)
+    runTaskImpl(configuration['needs'], taskName + "Finished", configuration, False, **kwargs);
+    preflight('postflight', taskName, configuration, **kwargs)
 
 
 def runTaskImpl(methodNames, taskName, configuration, fallback_allowed, **kwargs):
-  msg_printed = False
-  fn_called = False
-  for methodName in methodNames:
-    if not 'quiet' in kwargs and not msg_printed:
-      print yellow('Running task %s on configuration %s' % (taskName, configuration['config_name']))
-      msg_printed = True
-    fn = get(methodName, taskName)
-    if fn:
-      fn_called = True
-    callImpl(methodName, taskName, configuration, True, **kwargs)
-  if not fn_called and fallback_allowed:
-    for methodName in methodNames:
-      fn = get(methodName, 'fallback')
-      if fn:
-        fn(taskName, configuration, **kwargs)
+  table = get_dispatch_table(methodNames)
+  phase = resolve_phase(table, taskName)
+  if methodNames and not 'quiet' in kwargs:
+    print yellow('Running task %s on configuration %s' % (taskName, configuration['config_name']))
+  for override, fn in phase['calls']:
+    if override:
+      print "use override %s" % override
+
+  start_time = time.time()
+  with tracing.span(taskName, 'phase'):
+    for group in phase['groups']:
+      # Recorded plans should list the commands in a stable order.
+      if len(group) > 1 and not env.get('noParallelTasks') and not executor.is_recording():
+        run_parallel(group, configuration, kwargs)
+      else:
+        for fn in group:
+          call_hook(fn, configuration, **kwargs)
+    if not phase['implemented'] and fallback_allowed:
+      for fn in resolve_phase(table, 'fallback')['own']:
+        call_hook(fn, taskName, configuration, **kwargs)
+  history.add_phase(taskName, time.time() - start_time)
+
+
+def get_dispatch_plan(configuration, taskName):
+  """Returns the callables runTask would call for taskName, grouped by phase.
+
+  Every phase contains a list of groups, the callables of a group run concurrently.
+  """
+  table = get_dispatch_table(configuration['needs'])
+  plan = [ ('preflight', [ [ fn ] for fn in resolve_phase(table, 'preflight')['own'] ]) ]
+  for name in [taskName + 'Prepare', taskName, taskName + 'Finished']:
+    phase = resolve_phase(table, name)
+    groups = phase['groups']
+    if name == taskName and not phase['implemented']:
+      name = 'fallback'
+      groups = [ [ fn ] for fn in resolve_phase(table, 'fallback')['own'] ]
+    plan.append((name, groups))
+  plan.append(('postflight', [ [ fn ] for fn in resolve_phase(table, 'postflight')['own'] ]))
+
+  return plan
@@ -1,10 +1,63 @@
 from fabric.api import *
 from fabric.state import output, env
-from fabric.colors import green, red
+from fabric.colors import green, red, yellow
 from fabric.context_managers import env
 from fabric.network import *
-from fabric.contrib.files import exists
+from fabric.operations import _AttributeString, _prefix_commands
+from lib.executor import run, local, exists
+from lib import executor
+from lib import sshmux
+import fnmatch
+import json
+import pipes
 import re
+import uuid
+
+# Expanded executables and their compiled pattern, keyed by the name of the
+# configuration, its executables and the host-values they refer to.
+executables_cache = {}
+
+HOST_VARIABLE = re.compile(r'%host\.([^%]+)%')
+
+
+def get_executables_key(config):
+  values = []
+  for command in sorted(config['executables'].values()):
+    for path in HOST_VARIABLE.findall(command):
+      value = config
+      for key in path.split('.'):
+        value = value.get(key) if isinstance(value, dict) else None
+      values.append((path, str(value)))
+
+  return (config['config_name'], tuple(sorted(config['executables'].items())), tuple(values))
+
+
+def get_executables_pattern(keys):
+  # Longer names first, so `#!drush8` is not matched as `#!drush`.
+  if not keys:
+    return None
+  keys = sorted(keys, key=len, reverse=True)
+  return re.compile('#!(' + '|'.join(re.escape(key) for key in keys) + ')')
+
+
+def grep_escape(value):
+  """Escapes value for a basic regular expression of grep."""
+  return re.sub(r'([\\.\[\]*^$])', r'\\\1', value)
+
+
+# Backups are listed in this file inside the backupFolder, one json-object per line.
+BACKUP_MANIFEST = 'fabalicious-backups.jsonl'
+
+# Separates the manifest from the listing of the backupFolder.
+BACKUP_MANIFEST_SEPARATOR = '--- fabalicious-backup-files ---'
+
+# Number of files per command when rebuilding the manifest, a single argument
+# must not exceed 128 KiB.
+BACKUP_MANIFEST_CHUNK = 50
+
+# Parsed manifests and files per host and backup-folder, see
+# BaseMethod.read_backup_manifest.
+backup_manifests = {}
 
 
 class LocallyContext():
@@ -21,10 +74,119 @@ class LocallyContext():
       self.parent.run_locally = self.saved
 
 
+class CommandBatch(object):
+  """Collects the remote commands of run_quietly and runs them as one shell-script.
+
+  Every command runs in its own subshell with its working-directory and reports
+  its exit-code via a marker-line. Without warn_only the script stops at the
+  first failing command and the task is aborted, like run_quietly does.
+  """
+
+  def __init__(self, parent):
+    self.parent = parent
+    self.commands = []
+    self.saved = None
+
+  def __enter__(self):
+    # Commands of an enclosing batch run before the commands of this one.
+    self.saved = self.parent.current_batch
+    if self.saved:
+      self.saved.flush()
+    self.parent.current_batch = self
+    return self
+
+  def __exit__(self, type, value, traceback):
+    self.parent.current_batch = self.saved
+    if type is None:
+      self.flush()
+    else:
+      self.commands = []
+
+  def add(self, cmd, script, msg, hide_output):
+    self.commands.append({
+      'command': cmd,
+      'script': _prefix_commands(script, 'remote'),
+      'msg': msg,
+      'hide': hide_output,
+      'warn_only': 'warn_only' in env and env['warn_only']
+    })
+
+  def get_script(self, marker):
+    lines = []
+    for index, c in enumerate(self.commands):
+      lines.append('(\n%s\n); __status=$?; echo; echo "%s %d $__status"' % (c['script'], marker, index))
+      if not c['warn_only']:
+        lines.append('[ $__status -eq 0 ] || exit $__status')
+
+    return '\n'.join(lines)
+
+  def get_results(self, marker, result):
+    pattern = re.compile('^%s (\\d+) (\\d+)\r?$' % marker, re.MULTILINE)
+    return_codes = {}
+    outputs = {}
+    start = 0
+    for match in pattern.finditer(result):
+      index = int(match.group(1))
+      return_codes[index] = int(match.group(2))
+      # Strip the newline echoed before the marker.
+      outputs[index] = result[start:match.start()].rstrip('\r\n')
+      start = match.end() + 1
+
+    results = []
+    for index, c in enumerate(self.commands):
+      # All commands ran if the script succeeded, e.g. when only recording it.
+      if index not in return_codes and result.return_code == 0:
+        return_codes[index] = 0
+      command_result = _AttributeString(outputs.get(index, ''))
+      command_result.command = c['command']
+      command_result.return_code = return_codes.get(index, None)
+      command_result.succeeded = command_result.return_code == 0
+      command_result.failed = not command_result.succeeded
+      results.append(command_result)
+
+    return results
+
+  def flush(self):
+    """Runs all collected commands and returns their results, None for commands which did not run."""
+    if not self.commands:
+      return []
+
+    marker = '__fabalicious_batch_%s' % uuid.uuid4().hex
+    hide_output = set()
+    for c in self.commands:
+      hide_output.update(c['hide'])
+      if c['msg'] != '':
+        print c['msg']
+
+    with hide(*hide_output), settings(warn_only=True, cwd='', command_prefixes=[]):
+      result = run(self.get_script(marker))
+
+    results = self.get_results(marker, result)
+    commands = self.commands
+    self.commands = []
+
+    for c, command_result in zip(commands, results):
+      if command_result.failed and not c['warn_only']:
+        print red('%s failed' % c['command'])
+        print command_result
+        if output['aborts']:
+          raise SystemExit('%s failed' % c['command'])
+        break
+
+    return results
+
+
 class BaseMethod(object):
 
   verbose_output = True
   run_locally = False
+  executables = {}
+  executables_pattern = None
+  current_batch = None
+
+  # Tasks which may run concurrently to the same task of other methods, mapped
+  # to the list of methods which need to finish before.
+  parallelTasks = {}
 
   @staticmethod
   def supports(methodName):
@@ -93,6 +255,13 @@ class BaseMethod(object):
       parsed_commands.append(result)
 
     return parsed_commands
+  def get_ssh_options(self, config):
+    """Returns the ssh-options to share connections to the host, if commands run locally."""
+    # Only processes on this machine can use its control-sockets.
+    if not self.run_locally:
+      return ''
+    return sshmux.get_options(config['user'], config['host'], config['port'])
+
   def addPasswordToFabricCache(self, user, host, port, password, **kwargs):
     host_string = join_host_strings(user, host, port)
     env.passwords[host_string] = password
@@ -100,22 +269,127 @@ class BaseMethod(object):
 
   def list_remote_files(self, base_folder, patterns):
     result = []
-    with cd(base_folder), hide('running', 'output', 'warnings'), warn_only():
-      for pattern in patterns:
-        cmd = 'ls -l ' + pattern + ' 2>/dev/null'
-        output = run(cmd)
-        lines = output.stdout.splitlines()
-        for line in lines:
-          tokens = line.split()
-
-          if(len(tokens) >= 9):
-            result.append(tokens[8])
+    with self.cd(base_folder), hide('running', 'output', 'warnings'), warn_only():
+      # One name per line, names may contain spaces.
+      output = self.run('ls -1d ' + ' '.join(patterns) + ' 2>/dev/null', capture=True)
+      for line in output.splitlines():
+        if line.strip():
+          result.append(line.rstrip('\r'))
     return result
 
+  def get_backup_manifest_filename(self, config):
+    return config['backupFolder'] + '/' + BACKUP_MANIFEST
+
+  def get_backup_manifest_key(self, config):
+    return (self.run_locally, env.host_string, self.get_backup_manifest_filename(config))
+
+  def get_backup_manifest_command(self, config, file, hash, method):
+    """Returns a shell-command printing the manifest-entry for the backup-file, if it exists."""
+    entry = self.get_backup_result(config, file, hash, method)
+    if not entry:
+      return False
+
+    # Size and checksum are filled in on the host.
+    entry['size'] = '__size__'
+    entry['checksum'] = '__checksum__'
+    line = json.dumps(entry, sort_keys=True).replace('%', '%%')
+    line = line.replace('"__size__"', '%s').replace('__checksum__', '%s')
+    path = pipes.quote(config['backupFolder'] + '/' + file)
+
+    # Keys are sorted, the checksum comes before the size.
+    return 'test -f {path} && printf {line} "$( (sha1sum {path} 2>/dev/null || shasum {path}) | cut -d \' \' -f 1)" "$(wc -c < {path} | tr -d \' \')"'.format(
+      path=path, line=pipes.quote(line + '\\n'))
+
+  def add_to_backup_manifest(self, config, file, hash, method):
+    cmd = self.get_backup_manifest_command(config, file, hash, method)
+    if not cmd:
+      return
+
+    backup_manifests.pop(self.get_backup_manifest_key(config), None)
+    with hide('running', 'output', 'warnings'), warn_only():
+      result = self.run(cmd + ' >> ' + pipes.quote(self.get_backup_manifest_filename(config)))
+      if result.return_code != 0:
+        print yellow('Could not add %s to the backup-manifest, run `rebuildBackupManifest`.' % file)
+
+  def read_backup_manifest(self, config):
+    """Returns the entries of the backup-manifest, or None if there is none, and the files of the backupFolder."""
+    key = self.get_backup_manifest_key(config)
+    if key in backup_manifests:
+      return backup_manifests[key]
+
+    filename = pipes.quote(self.get_backup_manifest_filename(config))
+    # The first line tells if there is a manifest, one round-trip for both.
+    cmd = 'if test -f {filename}; then echo 0; cat {filename}; else echo 1; fi; echo {separator}; ls -1 {folder} 2>/dev/null'.format(
+      filename=filename, separator=pipes.quote(BACKUP_MANIFEST_SEPARATOR), folder=pipes.quote(config['backupFolder']))
+    with hide('running', 'output', 'warnings'), warn_only():
+      output = self.run(cmd, capture=True)
+
+    entries = None
+    files = []
+    lines = [ line.rstrip('\r') for line in output.splitlines() ]
+    if BACKUP_MANIFEST_SEPARATOR in lines and not executor.is_recording():
+      index = lines.index(BACKUP_MANIFEST_SEPARATOR)
+      if lines[0] == '0':
+        entries = []
+        for line in lines[1:index]:
+          try:
+            entries.append(json.loads(line))
+          except ValueError:
+            # Skip lines of interrupted writes.
+            pass
+      files = [ line for line in lines[index + 1:] if line ]
+
+    backup_manifests[key] = (entries, files)
+    return entries, files
+
+  def list_backups(self, config, results, method, patterns, extension):
+    """Adds the backups of the method found in the backupFolder to results, with the data of the manifest if available."""
+    entries, files = self.read_backup_manifest(config)
+
+    # Backups missing in the manifest were made before it existed, entries
+    # without a file were deleted.
+    listed = {}
+    for entry in entries or []:
+      if entry.get('method') == method and entry.get('config') == config['config_name']:
+        listed[entry.get('file')] = entry
+
+    for file in files:
+      if not any(fnmatch.fnmatch(file, pattern) for pattern in patterns):
+        continue
+      if file in listed:
+        results.append(listed[file])
+      else:
+        backup_result = self.get_backup_result(config, file, re.sub(extension, '', file), method)
+        if backup_result:
+          results.append(backup_result)
+
+  def rebuild_backup_manifest(self, config, method, patterns, extension):
+    """Replaces the manifest-entries of the method with the backups found in the backupFolder."""
+    cmds = []
+    for file in self.list_remote_files(config['backupFolder'], patterns):
+      cmd = self.get_backup_manifest_command(config, file, re.sub(extension, '', file), method)
+      if cmd:
+        cmds.append(cmd)
+
+    # Keys are sorted, config comes before method.
+    other_entries = '"config": %s, .*"method": %s,' % (grep_escape(json.dumps(config['config_name'])), grep_escape(json.dumps(method)))
+    filename = pipes.quote(self.get_backup_manifest_filename(config))
+    tmp_filename = pipes.quote(self.get_backup_manifest_filename(config) + '.tmp')
+
+    backup_manifests.pop(self.get_backup_manifest_key(config), None)
+    with hide('running', 'output', 'warnings'):
+      self.run('{ grep -v -e %s %s 2>/dev/null; true; } > %s' % (pipes.quote(other_entries), filename, tmp_filename))
+      # Long commands fail, add the entries in chunks.
+      for i in range(0, len(cmds), BACKUP_MANIFEST_CHUNK):
+        self.run('{ %s; true; } >> %s' % ('; '.join(cmds[i:i + BACKUP_MANIFEST_CHUNK]), tmp_filename))
+      self.run('mv %s %s' % (tmp_filename, filename))
+
+    print green('Added %d backups of %s to %s' % (len(cmds), method, self.get_backup_manifest_filename(config)))
+
 
   def get_backup_result(self, config, file, hash, method):
     tokens = hash.split('--')
-    if len(tokens) < 3:
+    if len(tokens) < 4:
       return False
     # be backwards compatible.
     if tokens[0] != config['config_name']:
@@ -148,14 +422,26 @@ class BaseMethod(object):
     self.setExecutables(config)
 
   def setExecutables(self, config):
-
-    self.executables = {}
-    replacements = self.expandVariables({ "host": config })
-    for key, command in config['executables'].iteritems():
-      cmds = [ command ];
-      cmds = self.expandCommands(cmds, replacements)
-      self.executables[key] = cmds[0]
-
+    # Flattening the config and compiling the pattern is done once per
+    # configuration, almost every hook calls setRunLocally.
+    key = get_executables_key(config)
+    entry = executables_cache.get(key)
+    if not entry:
+      executables = {}
+      replacements = self.expandVariables({ "host": config })
+      for key, command in config['executables'].iteritems():
+        executables[key] = self.expandCommands([ command ], replacements)[0]
+
+      if len(executables_cache) >= 64:
+        executables_cache.clear()
+      entry = {
+        'executables': executables,
+        'pattern': get_executables_pattern(executables.keys())
+      }
+      executables_cache[key] = entry
+
+    self.executables = entry['executables']
+    self.executables_pattern = entry['pattern']
 
 
   def cd(self, path):
@@ -164,9 +450,8 @@ class BaseMethod(object):
 
   def expandCommand(self, in_cmd):
     cmd = in_cmd
-    if len(self.executables) > 0:
-      pattern = re.compile('|'.join(re.escape("#!" + key) for key in self.executables.keys()))
-      cmd = pattern.sub(lambda x: self.executables[x.group()[2:]], cmd)
+    if self.executables and '#!' in cmd:
+      cmd = self.executables_pattern.sub(lambda x: self.executables[x.group(1)], cmd)
 
       if cmd.find('%arguments%') >= 0:
         arr = in_cmd.split(' ')
@@ -177,8 +462,17 @@ class BaseMethod(object):
 
     return cmd
 
+  def batch(self):
+    """Collects the remote commands of run_quietly and runs them in one go, see CommandBatch."""
+    return CommandBatch(self)
+
+  def flushBatch(self):
+    if self.current_batch:
+      self.current_batch.flush()
+
   def run(self, cmd, **kwargs):
     # print red("run: %d %s" % ( self.run_locally, cmd))
+    self.flushBatch()
     cmd = self.expandCommand(cmd)
 
     if self.run_locally:
@@ -189,6 +483,7 @@ class BaseMethod(object):
       return run(cmd, **kwargs)
 
   def exists(self, fname):
+    self.flushBatch()
     return os.path.isfile(fname) if self.run_locally else exists(fname)
 
 
@@ -196,22 +491,26 @@ class BaseMethod(object):
     if 'warn_only' in env and env['warn_only']:
       may_fail = True
 
-    if msg != '':
-      print msg
-
     if not hide_output:
       hide_output = ['running', 'output', 'warnings']
 
     if self.verbose_output:
       hide_output=[]
 
+    # Collect the command, it runs when the batch is flushed.
+    if self.current_batch and not self.run_locally:
+      self.current_batch.add(cmd, self.expandCommand(cmd), msg, hide_output)
+      return None
+
+    if msg != '':
+      print msg
 
     with hide(*hide_output):
       try:
         result = self.run(cmd)
 
         if not may_fail and result.return_code != 0:
-          print red('%s failed:' %s)
+          print red('%s failed:' % cmd)
           print result
 
         return result
@@ -3,8 +3,10 @@ from fabric.api import *
 from fabric.network import *
 from fabric.context_managers import settings as _settings
 from fabric.context_managers import env
+from lib.executor import run, local, put
 from fabric.colors import green, red
 from lib import configuration
+from lib import sshmux
 import copy
 from lib.utils import validate_dict
 
@@ -30,14 +32,16 @@ class DockerMethod(BaseMethod):
     config_name = config['docker']['configuration']
     data = False
     # Check if configuration points to an external source.
-    if config_name[0:7] == 'http://' or config_name[0:8] == 'https://':
-      data = configuration.get_configuration_via_http(config_name)
-      data = configuration.resolve_inheritance(data, {})
-    elif config_name[0:1] == '.':
-      data = configuration.get_configuration_via_file(config_name)
-      data = configuration.resolve_inheritance(data, {})
+    if config_name[0:7] == 'http://' or config_name[0:8] == 'https://' or config_name[0:1] == '.':
+      data = configuration.resolve_reference(config_name, settings['dockerHosts'])
     if data:
-      settings['dockerHosts'][config_name] = data
+      # Merged settings share their dockerHosts with the loaded data, replace
+      # them instead of changing them.
+      docker_hosts = settings['dockerHosts']
+      if isinstance(docker_hosts, dict):
+        docker_hosts = dict(docker_hosts)
+      docker_hosts[config_name] = data
+      settings['dockerHosts'] = docker_hosts
 
     if 'tag' not in config['docker']:
       config['docker']['tag'] = 'latest'
@@ -110,7 +114,8 @@ class DockerMethod(BaseMethod):
     if 'ip' in kwargs:
       public_ip = kwargs['ip']
     print green("I am about to start the port forwarding via SSH. If you are finished, just type exit after the prompt.")
-    local("ssh -L%s:%s:%s:%s -p %s %s@%s" % (public_ip, publicPort, ip, port, docker_config['port'], docker_config['user'], docker_config['host']))
+    options = sshmux.get_options(docker_config['user'], docker_config['host'], docker_config['port'])
+    local("ssh %s-L%s:%s:%s:%s -p %s %s@%s" % (options, public_ip, publicPort, ip, port, docker_config['port'], docker_config['user'], docker_config['host']))
     exit(0)
 
   def about(self, config, **kwargs):
@@ -149,22 +154,29 @@ class DockerMethod(BaseMethod):
       if key_file:
         put(key_file, '/root/.ssh/id_rsa')
         put(key_file+'.pub', '/root/.ssh/id_rsa.pub')
-        run('chmod 600 /root/.ssh/id_rsa')
-        run('chmod 644 /root/.ssh/id_rsa.pub')
         put(key_file+'.pub', '/tmp')
-        run('cat /tmp/'+os.path.basename(key_file)+'.pub >> /root/.ssh/authorized_keys')
-        run('rm /tmp/'+os.path.basename(key_file)+'.pub')
-        print green('Copied keyfile to docker.')
-
       if authorized_keys_file:
         put(authorized_keys_file, '/root/.ssh/authorized_keys')
-        print green('Copied authorized keys to docker.')
-
       if known_hosts_file:
         put(known_hosts_file, '/root/.ssh/known_hosts')
-        print green('Copied known hosts to docker.')
 
-      run('chmod 700 /root/.ssh')
+      # Fix permissions in one go after all files are uploaded.
+      with self.batch():
+        if key_file:
+          self.run_quietly('chmod 600 /root/.ssh/id_rsa')
+          self.run_quietly('chmod 644 /root/.ssh/id_rsa.pub')
+          # An uploaded authorized_keys-file replaces the key.
+          if not authorized_keys_file:
+            self.run_quietly('cat /tmp/'+os.path.basename(key_file)+'.pub >> /root/.ssh/authorized_keys')
+          self.run_quietly('rm /tmp/'+os.path.basename(key_file)+'.pub')
+        self.run_quietly('chmod 700 /root/.ssh')
+
+      if key_file:
+        print green('Copied keyfile to docker.')
+      if authorized_keys_file:
+        print green('Copied authorized keys to docker.')
+      if known_hosts_file:
+        print green('Copied known hosts to docker.')
 
   def waitForServices(self, config, **kwargs):
     if 'ssh' not in config['needs'] or not config['executables']['supervisorctl']:
@@ -3,7 +3,7 @@ from fabric.api import *
 from lib.utils import SSHTunnel, RemoteSSHTunnel
 from fabric.colors import green, red
 from lib import configuration
-from fabric.contrib.files import exists
+from lib.executor import exists
 
 import copy
 
@@ -4,6 +4,7 @@ from fabric.state import output, env
 from fabric.colors import green, red
 from fabric.network import *
 from fabric.context_managers import settings as _settings
+from lib.executor import run, local, put
 from lib import configuration
 from lib import utils
 import re
@@ -11,6 +12,8 @@ from lib.utils import validate_dict
 
 class DrushMethod(BaseMethod):
 
+  parallelTasks = { 'backup': [] }
+
   @staticmethod
   def supports(methodName):
     return methodName == 'drush7' or methodName == 'drush8' or methodName == 'drush'
@@ -137,15 +140,16 @@ class DrushMethod(BaseMethod):
     self.backupSql(config, filename)
     if config['supportsZippedBackups']:
       filename += '.gz'
+    self.add_to_backup_manifest(config, os.path.basename(filename), '--'.join(baseName), 'drush')
     print green('Database dump at "%s"' % filename)
 
   def listBackups(self, config, results, **kwargs):
-    files = self.list_remote_files(config['backupFolder'], ['*.sql', '*.sql.gz'])
-    for file in files:
-      hash = re.sub('\.(sql\.gz|sql)$', '', file)
-      backup_result = self.get_backup_result(config, file, hash, 'drush')
-      if backup_result:
-        results.append(backup_result)
+    self.setRunLocally(config)
+    self.list_backups(config, results, 'drush', ['*.sql', '*.sql.gz'], '\.(sql\.gz|sql)$')
+
+  def rebuildBackupManifest(self, config, **kwargs):
+    self.setRunLocally(config)
+    self.rebuild_backup_manifest(config, 'drush', ['*.sql', '*.sql.gz'], '\.(sql\.gz|sql)$')
 
   def restore(self, config, files=False, cleanupBeforeRestore=False, **kwargs):
 
@@ -191,7 +195,7 @@ class DrushMethod(BaseMethod):
     if source_config['supportsZippedBackups']:
       sql_name_source += '.gz'
 
-    args = utils.ssh_no_strict_key_host_checking_params
+    args = utils.ssh_no_strict_key_host_checking_params + self.get_ssh_options(source_config)
 
     cmd = '#!scp -P {port} {args} {user}@{host}:{sql_name_source} {sql_name_target} '.format(  args=args,
       sql_name_source=sql_name_source,
@@ -240,18 +244,20 @@ class DrushMethod(BaseMethod):
     o = config['database']
 
     with self.cd(config['siteFolder']):
-      self.run_quietly('mkdir -p %s' % config['siteFolder'])
-      if not o["skipCreateDatabase"]:
-        mysql_cmd  = 'CREATE DATABASE IF NOT EXISTS {name}; GRANT ALL PRIVILEGES ON {name}.* TO \'{user}\'@\'%\' IDENTIFIED BY \'{pass}\'; FLUSH PRIVILEGES;'.format(**o)
+      with self.batch():
+        self.run_quietly('mkdir -p %s' % config['siteFolder'])
+        if not o["skipCreateDatabase"]:
+          mysql_cmd  = 'CREATE DATABASE IF NOT EXISTS {name}; GRANT ALL PRIVILEGES ON {name}.* TO \'{user}\'@\'%\' IDENTIFIED BY \'{pass}\'; FLUSH PRIVILEGES;'.format(**o)
 
-        self.run_quietly('#!mysql -h {host} -u {user} --password={pass} -e "{mysql_command}"'.format(mysql_command=mysql_cmd, **o), 'Creating database')
+          self.run_quietly('#!mysql -h {host} -u {user} --password={pass} -e "{mysql_command}"'.format(mysql_command=mysql_cmd, **o), 'Creating database')
 
-      with warn_only():
-        self.run_quietly('chmod u+w {siteFolder}'.format(**config))
-        self.run_quietly('chmod u+w {siteFolder}/settings.php'.format(**config))
-        self.run_quietly('rm -f {siteFolder}/settings.php.old'.format(**config))
-        self.run_quietly('mv {siteFolder}/settings.php {siteFolder}/settings.php.old 2>/dev/null'.format(**config))
+        with warn_only():
+          self.run_quietly('chmod u+w {siteFolder}'.format(**config))
+          self.run_quietly('chmod u+w {siteFolder}/settings.php'.format(**config))
+          self.run_quietly('rm -f {siteFolder}/settings.php.old'.format(**config))
+          self.run_quietly('mv {siteFolder}/settings.php {siteFolder}/settings.php.old 2>/dev/null'.format(**config))
 
+      with warn_only():
         sites_folder = os.path.basename(config['siteFolder'])
         options = ''
         if ask.lower() == 'false' or ask.lower() == '0':
@@ -277,7 +283,7 @@ class DrushMethod(BaseMethod):
       self.setupConfigurationManagement(config)
 
   def setupConfigurationManagement(self, config):
-    with self.runLocally(config), self.cd(config['siteFolder']):
+    with self.runLocally(config), self.cd(config['siteFolder']), self.batch():
       self.run_quietly('chmod u+w .');
       self.run_quietly('chmod u+w settings.php');
       for configName in config['configurationManagement']:
@@ -7,9 +7,11 @@ import re
 from lib import utils
 from lib import configuration
 from lib.utils import validate_dict
-from fabric.contrib.files import exists
+from lib.executor import local, put, get, exists
 
 class FilesMethod(BaseMethod):
+
+  parallelTasks = { 'backup': [] }
   @staticmethod
   def supports(methodName):
     return methodName == 'files'
@@ -59,15 +61,16 @@ class FilesMethod(BaseMethod):
 
     if len(source_folders) > 0:
       self.tarFiles(config, filename, source_folders, 'backup')
+      self.add_to_backup_manifest(config, os.path.basename(filename), '--'.join(baseName), 'files')
       print green('Files dumped into "%s"' % filename)
 
   def listBackups(self, config, results, **kwargs):
-    files = self.list_remote_files(config['backupFolder'], ['*.tgz'])
-    for file in files:
-      hash = re.sub('\.tgz$', '', file)
-      backup_result = self.get_backup_result(config, file, hash, 'files')
-      if backup_result:
-        results.append(backup_result)
+    self.setRunLocally(config)
+    self.list_backups(config, results, 'files', ['*.tgz'], '\.tgz$')
+
+  def rebuildBackupManifest(self, config, **kwargs):
+    self.setRunLocally(config)
+    self.rebuild_backup_manifest(config, 'files', ['*.tgz'], '\.tgz$')
 
   def restore(self, config, files=False, cleanupBeforeRestore=False, **kwargs):
     self.setRunLocally(config)
@@ -79,17 +82,18 @@ class FilesMethod(BaseMethod):
     # move current files folder to backup
     ts = datetime.datetime.now().strftime('%Y%m%d.%H%M%S')
     old_files_folder = config['filesFolder'] + '.' + ts + '.old'
-    with warn_only():
-      self.run_quietly('chmod u+w ' + os.path.dirname(config['filesFolder']))
-      self.run_quietly('chmod -R u+x '+config['filesFolder'])
-      self.run_quietly('rm -rf '+ old_files_folder)
-      self.run_quietly('mv ' + config['filesFolder'] + ' '+old_files_folder)
-
-    tar_file = config['backupFolder'] + '/' + file['file']
-    self.run_quietly('mkdir -p ' + config['filesFolder'])
-    self.run_quietly('chmod -R 777 ' + config['filesFolder'])
-    with cd(config['filesFolder']):
-      self.run_quietly('#!tar -xzPf ' + tar_file, 'Unpacking files')
+    with self.batch():
+      with warn_only():
+        self.run_quietly('chmod u+w ' + os.path.dirname(config['filesFolder']))
+        self.run_quietly('chmod -R u+x '+config['filesFolder'])
+        self.run_quietly('rm -rf '+ old_files_folder)
+        self.run_quietly('mv ' + config['filesFolder'] + ' '+old_files_folder)
+
+      tar_file = config['backupFolder'] + '/' + file['file']
+      self.run_quietly('mkdir -p ' + config['filesFolder'])
+      self.run_quietly('chmod -R 777 ' + config['filesFolder'])
+      with cd(config['filesFolder']):
+        self.run_quietly('#!tar -xzPf ' + tar_file, 'Unpacking files')
 
     print(green('files restored from ' + file['file']))
 
@@ -110,7 +114,7 @@ class FilesMethod(BaseMethod):
 
 
       rsync = '#!rsync -rav --no-o --no-g  -e "ssh -T -o Compression=no {ssh_args} -p {port}" {rsync_args} {user}@{host}:{source_dir}/* {target_dir}'.format(
-        ssh_args=utils.ssh_no_strict_key_host_checking_params,
+        ssh_args=utils.ssh_no_strict_key_host_checking_params + self.get_ssh_options(source_config),
         source_dir=source_config[folder],
         target_dir=target_config[folder],
         rsync_args=rsync_args,
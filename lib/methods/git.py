@@ -1,9 +1,11 @@
 from base import BaseMethod
 from fabric.api import *
 from fabric.colors import green, red
+from lib.executor import sudo
 from lib.utils import validate_dict
 from lib.configuration import data_merge
 from lib import configuration
+from lib import history
 
 class GitMethod(BaseMethod):
   @staticmethod
@@ -33,6 +35,7 @@ class GitMethod(BaseMethod):
         output = self.run('#!git describe --always', capture = True)
         output = output.stdout.splitlines()
         result = output[-1].replace('/', '-')
+        history.annotate('version', result)
         return result
 
   def getCommitHash(self, config):
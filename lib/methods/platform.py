@@ -1,6 +1,7 @@
 from base import BaseMethod
 from fabric.api import *
 from fabric.colors import green, red
+from lib.executor import local
 from lib import configuration
 from drush import DrushMethod
 
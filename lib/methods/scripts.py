@@ -1,11 +1,13 @@
 from base import BaseMethod
 from fabric.api import *
-from fabric.contrib.files import exists
 from fabric.network import *
 from fabric.context_managers import settings as _settings
+from lib.executor import run, local, exists
 from fabric.colors import green, red, yellow
 from lib import configuration
-import re, copy
+from lib import statcache
+import re
+import copy
 
 class ScriptMethod(BaseMethod):
   @staticmethod
@@ -53,6 +55,9 @@ class ScriptMethod(BaseMethod):
     saved_output_prefix = env.output_prefix
     env.output_prefix = False
 
+    if not runLocally:
+      self.prefetchDirectories(rootFolder, commands)
+
     for line in commands:
       with self.cd(rootFolder, runLocally), shell_env(**environment), hide('running'), show('output'):
         handled = False
@@ -90,6 +95,20 @@ class ScriptMethod(BaseMethod):
     return state['return_code']
 
 
+  def prefetchDirectories(self, rootFolder, commands):
+    # Check the directories of the leading fail_on_missing_directory-lines in
+    # one go, later lines might check directories created by the script.
+    directories = []
+    for line in commands:
+      if not line.startswith('fail_on_missing_directory('):
+        break
+      directories.append(line[line.find('(') + 1:line.rfind(')')].split(',')[0].strip())
+
+    if len(directories) > 1:
+      with self.cd(rootFolder, False), hide('running'):
+        statcache.prefetch(directories)
+
+
   def expandEnvironment(self, environment, replacements):
     parsed_environment = {}
     pattern = re.compile('|'.join(re.escape(key) for key in replacements.keys()))
@@ -140,9 +159,9 @@ class ScriptMethod(BaseMethod):
     if 'environment' in config:
       environment = configuration.data_merge(config['environment'], environment)
     variables['host'] = config
-    settings = copy.deepcopy(configuration.getSettings())
-    map(lambda x: settings.pop(x,None), ['hosts', 'dockerHosts'])
-    variables['settings'] = settings
+    settings = configuration.getSettings()
+    # The settings are merged data shared with every configuration.
+    variables['settings'] = copy.deepcopy(dict((key, value) for key, value in settings.iteritems() if key not in ['hosts', 'dockerHosts']))
 
     callbacks['execute'] = self.executeCallback
     callbacks['run_task'] = self.runTaskCallback
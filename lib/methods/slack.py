@@ -2,6 +2,7 @@ from base import BaseMethod
 from fabric.api import *
 from fabric.colors import green, red
 from lib import configuration
+from lib import executor
 import json
 import getpass
 from lib.utils import validate_dict
@@ -32,6 +33,10 @@ class SlackMethod(BaseMethod):
     if type != 'always' and type not in slack_config['notifyOn']:
       return
 
+    if executor.is_recording():
+      executor.record('slack', channel=slack_config['channel'], message=message)
+      return
+
     try:
       __import__('imp').find_module('slacker')
       from slacker import Slacker
@@ -3,13 +3,20 @@ from fabric.api import *
 from lib.utils import SSHTunnel, RemoteSSHTunnel
 from fabric.colors import green, red
 from fabric.network import *
+from lib import executor
+from lib import history
+from lib.executor import local
 from lib import configuration
+from lib import sshmux
+from lib import tunnelbroker
 import copy
-import random
 from lib.utils import validate_dict
 
 class SSHMethod(BaseMethod):
+  # Live tunnels keyed by bridge and destination, shared by all configurations.
   tunnels = {}
+  # The key of the tunnel used by a pair of configurations.
+  tunnelUsers = {}
   tunnelCreating = False
 
 
@@ -37,14 +44,13 @@ class SSHMethod(BaseMethod):
       docker_name = config["docker"]["name"]
       config["sshTunnel"]["destHostFromDockerContainer"] = docker_name
 
-    if "sshTunnel" in config:
-      if not 'localPort' in config['sshTunnel']:
-        if 'port' in config:
-          config['sshTunnel']['localPort'] = config['port']
-        else:
-          port = random.randrange(1025, 65535)
-          config['sshTunnel']['localPort'] = port
-          config['port'] = port
+    if "sshTunnel" in config and not 'localPort' in config['sshTunnel']:
+      if 'port' in config:
+        config['sshTunnel']['localPort'] = config['port']
+      else:
+        # The configuration might get compiled and used by concurrent runs,
+        # configuration.get() assigns a free port for this run.
+        return
 
     if 'port' not in config:
       config['port'] = 22
@@ -60,22 +66,47 @@ class SSHMethod(BaseMethod):
       open_shell()
 
 
-  def create_ssh_tunnel(self, msg, source_config, target_config, remote=False):
-
+  def get_tunnel_user(self, source_config, target_config, remote):
     key = source_config['config_name'] + "--" + target_config['config_name']
     if remote:
       key = key + '--remote'
+    return key
+
 
-    if key not in self.tunnels:
-      self.tunnels[key] = {'creating': False, 'tunnel': None, 'created': False }
+  def get_tunnel_key(self, source_config, o, remote):
+    key = (o['bridgeUser'], o['bridgeHost'], o['bridgePort'], o['destHost'], o['destPort'])
+    # Remote tunnels listen on the host, the configuration expects the same
+    # port there as locally.
+    if remote:
+      key = (source_config['user'], source_config['host'], source_config['port'], o['localPort']) + key
+    return key
+
+
+  def create_ssh_tunnel(self, msg, source_config, target_config, remote=False):
 
-    if self.tunnels[key]['creating'] or self.tunnels[key]['created']:
-      return self.tunnels[key]['tunnel']
+    user = self.get_tunnel_user(source_config, target_config, remote)
 
-    self.tunnels[key]['creating'] = True
+    if user in self.tunnelUsers:
+      key = self.tunnelUsers[user]
+      if not key:
+        return None
+
+      # Fresh copies of the configuration know only its configured port.
+      tunnel = self.tunnels[key]['tunnel']
+      if tunnel.local_port != target_config['sshTunnel']['localPort']:
+        self.use_tunnel_port(target_config, tunnel.local_port)
+      return tunnel
+
+    self.tunnelUsers[user] = False
 
     print "%s" % msg,
 
+    if executor.is_recording():
+      print 'skipped.'
+      executor.record('tunnel', source=source_config['config_name'], target=target_config['config_name'], remote=remote)
+      del self.tunnelUsers[user]
+      return False
+
     o = copy.deepcopy(target_config['sshTunnel'])
 
     if 'destHost' not in o:
@@ -88,29 +119,77 @@ class SSHMethod(BaseMethod):
 
     if 'destHost' not in o or not o['destHost']:
       print red('Could not get remote ip-address!')
-      self.tunnels[key]['creating'] = False
+      del self.tunnelUsers[user]
 
       return False
 
-    strictHostKeyChecking = o['strictHostKeyChecking'] if 'strictHostKeyChecking' in o else True
-
-    if remote:
-      tunnel = RemoteSSHTunnel(source_config, o['bridgeUser'], o['bridgeHost'], o['destHost'], o['bridgePort'], o['destPort'], o['localPort'], strictHostKeyChecking)
+    key = self.get_tunnel_key(source_config, o, remote)
+    if key in self.tunnels and self.tunnels[key]['tunnel'].alive():
+      tunnel = self.tunnels[key]['tunnel']
+      print "reusing tunnel on port %s ..." % tunnel.local_port,
     else:
-      tunnel = SSHTunnel(o['bridgeUser'], o['bridgeHost'], o['destHost'], o['bridgePort'], o['destPort'], o['localPort'], strictHostKeyChecking)
+      strictHostKeyChecking = o['strictHostKeyChecking'] if 'strictHostKeyChecking' in o else True
 
-    self.tunnels[key]['tunnel'] = tunnel
-    self.tunnels[key]['created'] = tunnel != False
-    self.tunnels[key]['creating'] = False
+      if remote:
+        tunnel = RemoteSSHTunnel(source_config, o['bridgeUser'], o['bridgeHost'], o['destHost'], o['bridgePort'], o['destPort'], o['localPort'], strictHostKeyChecking)
+      elif tunnelbroker.enabled():
+        tunnel = self.open_brokered_tunnel(o, strictHostKeyChecking)
+      else:
+        tunnel = SSHTunnel(o['bridgeUser'], o['bridgeHost'], o['destHost'], o['bridgePort'], o['destPort'], o['localPort'], strictHostKeyChecking)
 
-    if self.tunnels[key]['created']:
-      print green('Tunnel established')
-    else:
-      print red('Tunnel creation failed')
+      if not tunnel:
+        del self.tunnelUsers[user]
+        print red('Tunnel creation failed')
+        return tunnel
+
+      self.tunnels[key] = { 'tunnel': tunnel, 'users': 0 }
+
+    self.tunnels[key]['users'] += 1
+    self.tunnelUsers[user] = key
+
+    # Another configuration might have opened the tunnel on another port.
+    if tunnel.local_port != o['localPort']:
+      self.use_tunnel_port(target_config, tunnel.local_port)
+
+    print green('Tunnel established')
 
     return tunnel
 
 
+  def release_ssh_tunnel(self, source_config, target_config, remote=False):
+    """Closes the tunnel, if no other pair of configurations uses it."""
+    key = self.tunnelUsers.pop(self.get_tunnel_user(source_config, target_config, remote), False)
+    if not key:
+      return
+
+    self.tunnels[key]['users'] -= 1
+    if self.tunnels[key]['users'] == 0:
+      self.tunnels.pop(key)['tunnel'].terminate()
+
+
+  def use_tunnel_port(self, config, port):
+    if config['port'] == config['sshTunnel']['localPort']:
+      config['port'] = port
+      if config['config_name'] in configuration.tunnel_ports:
+        configuration.tunnel_ports[config['config_name']] = port
+      if env.get('config', {}).get('config_name') == config['config_name']:
+        env.port = port
+        env.host_string = join_host_strings(config['user'], config['host'], port)
+        # Fabric restores the port after every task, later tasks use the hosts.
+        env.hosts = [ env.host_string ]
+    config['sshTunnel']['localPort'] = port
+
+
+  def open_brokered_tunnel(self, o, strictHostKeyChecking):
+    try:
+      data = tunnelbroker.open_tunnel(bridgeUser=o['bridgeUser'], bridgeHost=o['bridgeHost'], bridgePort=o['bridgePort'], destHost=o['destHost'], destPort=o['destPort'], localPort=o['localPort'], strictHostKeyChecking=strictHostKeyChecking)
+    except IOError as e:
+      print red(str(e)),
+      return False
+
+    return tunnelbroker.BrokerTunnel(data)
+
+
   def createTunnelFromLocalToHost(self, config):
     msg = "Establishing SSH-Tunnel from local to {config_name}...".format(**config),
     self.create_ssh_tunnel(msg, config, config, False)
@@ -140,6 +219,16 @@ class SSHMethod(BaseMethod):
           self.createTunnelFromHostToSource(config, source_config)
 
 
+  def postflight(self, task, config, **kwargs):
+    # The tunnels to the source are not needed anymore, copyFrom runs
+    # copyDBFrom and copyFilesFrom, so release them when the task is done.
+    if task in ['copyDBFrom', 'copyFilesFrom']:
+      source_config = kwargs['source_config']
+      if source_config and 'sshTunnel' in source_config:
+        history.defer(self.release_ssh_tunnel, config, source_config, False)
+        history.defer(self.release_ssh_tunnel, config, source_config, True)
+
+
   def preflight(self, task, config, **kwargs):
     # print('ssh.preflight: %s %s' % (self.tunnel_creating, config['config_name']))
     if not self.tunnelCreating:
@@ -149,7 +238,8 @@ class SSHMethod(BaseMethod):
 
 
   def doctor_ssh_connection(self, config):
-    output = local('ssh -A -o StrictHostKeyChecking=no -o PasswordAuthentication=no -o BatchMode=yes -o ConnectTimeout=5 -p {port} {user}@{host} echo ok'.format(**config), capture=True)
+    options = sshmux.get_options(config['user'], config['host'], config['port'])
+    output = local('ssh -A -o StrictHostKeyChecking=no -o PasswordAuthentication=no -o BatchMode=yes -o ConnectTimeout=5 {options}-p {port} {user}@{host} echo ok'.format(options=options, **config), capture=True)
     if output.return_code != 0:
       print red('Cannot connect to host! Please check if the host is running and reachable, and check if your public key is added to authorized_keys on the remote host.')
       print red('Try: ssh -p {port} {user}@{host}'.format(**config))
@@ -215,7 +305,8 @@ class SSHMethod(BaseMethod):
 
         ssh_cmd = 'ssh -A -o StrictHostKeyChecking=no -o PasswordAuthentication=no -o BatchMode=yes -o ConnectTimeout=5'
         cmd_on_host = ssh_cmd + " -p {port} {user}@{host} echo ok".format(**remote_config)
-        cmd = ssh_cmd + ' -p {port} {user}@{host} "' + cmd_on_host + '"'
+        cmd = ssh_cmd + ' ' + sshmux.get_options(config['user'], config['host'], config['port'])
+        cmd = cmd + '-p {port} {user}@{host} "' + cmd_on_host + '"'
 
         cmd = cmd.format(**config)
         print "Check SSH-connection from %s to %s: " % (config['config_name'], remote_config['config_name']),
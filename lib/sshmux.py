@@ -0,0 +1,66 @@
+import atexit
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+from fabric.state import env
+from lib import executor
+
+# Shares one connection per user, host and port between all ssh-, scp- and
+# rsync-processes fabalicious runs locally, using ssh's ControlMaster. The
+# first process opens the connection, the masters are closed when fabalicious
+# exits. Disable it with `fab --set noSSHMultiplexing`.
+
+# Masters of forked processes which exit without cleaning up close
+# themselves after being idle for this many seconds.
+PERSIST = 60
+
+folder = False
+owner = False
+
+
+def enabled():
+  return not env.get('noSSHMultiplexing', False) and not executor.is_recording()
+
+
+def get_folder():
+  """Returns the folder for the control-sockets of this run, forked processes share it."""
+  global folder, owner
+
+  if not folder:
+    folder = tempfile.mkdtemp(prefix='fabalicious-ssh-')
+    owner = os.getpid()
+    atexit.register(close)
+
+  return folder
+
+
+def get_control_path(user, host, port=22):
+  # Unix-sockets have a short maximum path-length, hash the host.
+  name = hashlib.sha1('%s@%s:%s' % (user, host, port)).hexdigest()[:16]
+  return os.path.join(get_folder(), name)
+
+
+def get_options(user, host, port=22):
+  """Returns the ssh-options to share the connection to the host followed by a space, an empty string if disabled."""
+  if not enabled():
+    return ''
+
+  return '-o ControlMaster=auto -o ControlPath=%s -o ControlPersist=%d ' % (get_control_path(user, host, port), PERSIST)
+
+
+def close():
+  """Closes all masters of this run."""
+  global folder
+
+  if not folder or os.getpid() != owner:
+    return
+
+  with open(os.devnull, 'w') as devnull:
+    for name in os.listdir(folder):
+      # The host is not used when the control-path is given.
+      subprocess.call([ 'ssh', '-o', 'ControlPath=' + os.path.join(folder, name), '-O', 'exit', 'fabalicious' ], stdout=devnull, stderr=devnull)
+
+  shutil.rmtree(folder, ignore_errors=True)
+  folder = False
@@ -0,0 +1,212 @@
+import pipes
+import posixpath
+import re
+import shlex
+from fabric.api import hide, settings
+from fabric.state import env
+
+# Remembers per host which paths exist and of which type, so repeated
+# exists()-checks do not cost a round-trip each. prefetch() checks a list of
+# paths with one command. Commands run via lib.executor invalidate the paths
+# they create or delete, unknown commands clear the cache of their host, see
+# invalidate_command().
+
+# host_string -> { path: 'dir' | 'file' | 'other' | None }
+hosts = {}
+
+# Commands creating or deleting their arguments.
+MODIFYING = ['cp', 'ln', 'mkdir', 'mv', 'rm', 'rmdir', 'touch']
+
+# Commands which never change files, everything else clears the cache.
+READ_ONLY = ['[', 'cat', 'cd', 'echo', 'exit', 'grep', 'head', 'ls', 'printf', 'pwd', 'stat', 'tail', 'test', 'true', 'wc']
+
+TYPES = { 'd': 'dir', 'f': 'file', 'o': 'other', '-': None }
+
+REDIRECTION = re.compile(r'^\d*(>>?|&>>?)(.*)$')
+UNRESOLVABLE = re.compile(r'[$`~*?\[]')
+
+
+def get_cache():
+  return hosts.setdefault(env.host_string, {})
+
+
+def clear():
+  hosts.clear()
+
+
+def resolve(path, cwd):
+  """Returns the normalized absolute path or None, if it depends on the shell."""
+  if not path or UNRESOLVABLE.search(path):
+    return None
+  if not path.startswith('/'):
+    if not cwd or not cwd.startswith('/') or UNRESOLVABLE.search(cwd):
+      return None
+    path = cwd + '/' + path
+
+  return posixpath.normpath(path)
+
+
+def prefetch(paths):
+  """Checks all paths not cached yet with one command, relative paths are relative to env.cwd."""
+  from lib import executor
+
+  cache = get_cache()
+  keys = []
+  for path in paths:
+    key = resolve(path, env.cwd)
+    if key and key not in cache and key not in keys:
+      keys.append(key)
+
+  if not keys:
+    return
+
+  cmd = 'for p in %s; do if [ -d "$p" ]; then echo d; elif [ -f "$p" ]; then echo f; elif [ -e "$p" ]; then echo o; else echo -; fi; done' % ' '.join(pipes.quote(key) for key in keys)
+  backend = executor.get_backend()
+  with settings(hide('everything'), warn_only=True):
+    result = executor.traced('run', cmd, backend.run, cmd)
+
+  lines = [ line.strip() for line in result.splitlines() if line.strip() in TYPES ]
+  # Cache nothing if the output is garbled, e.g. by a login-banner.
+  if len(lines) == len(keys):
+    for key, line in zip(keys, lines):
+      cache[key] = TYPES[line]
+
+
+def get_type(path):
+  """Returns 'dir', 'file', 'other' or None if the path does not exist, False if unknown."""
+  key = resolve(path, env.cwd)
+  if not key:
+    return False
+
+  cache = get_cache()
+  if key not in cache:
+    prefetch([ path ])
+
+  return cache.get(key, False)
+
+
+def exists(path):
+  path_type = get_type(path)
+  if path_type is False:
+    from lib import executor
+    backend = executor.get_backend()
+    return executor.traced('exists', path, backend.exists, path)
+
+  return path_type is not None
+
+
+def is_dir(path):
+  path_type = get_type(path)
+  if path_type is False:
+    return exists(path + '/.')
+
+  return path_type == 'dir'
+
+
+def invalidate(path):
+  """Forgets the path, everything below it and its parents."""
+  cache = get_cache()
+  for key in cache.keys():
+    if key == path or key.startswith(path + '/') or path.startswith(key + '/'):
+      del cache[key]
+
+
+def split_command(cmd):
+  """Splits a shell-command into simple commands at unquoted ;, &, |, newlines and parentheses.
+
+  Parentheses are returned as None, subshells do not change the working-directory of the parent.
+  """
+  segments = []
+  current = []
+  quote = False
+  escaped = False
+  for char in cmd:
+    if escaped:
+      current.append(char)
+      escaped = False
+    elif char == '\\' and quote != "'":
+      current.append(char)
+      escaped = True
+    elif quote:
+      current.append(char)
+      if char == quote:
+        quote = False
+    elif char in '\'"':
+      current.append(char)
+      quote = char
+    elif char == '&' and current and current[-1] == '>':
+      current.append(char)
+    elif char in ';&|\n()':
+      segments.append(''.join(current))
+      if char in '()':
+        segments.append(None)
+      current = []
+    else:
+      current.append(char)
+
+  segments.append(''.join(current))
+  return [ segment for segment in segments if segment is None or segment.strip() ]
+
+
+def get_modified_paths(tokens):
+  """Returns the arguments of the simple command, its redirection-targets and the remaining tokens."""
+  paths = []
+  remaining = []
+  index = 0
+  while index < len(tokens):
+    match = REDIRECTION.match(tokens[index])
+    if match:
+      target = match.group(2)
+      if not target and index + 1 < len(tokens):
+        index += 1
+        target = tokens[index]
+      if target and not target.startswith('&'):
+        paths.append(target)
+    else:
+      remaining.append(tokens[index])
+    index += 1
+
+  # Skip variable-assignments and sudo.
+  while remaining and ('=' in remaining[0] and not remaining[0].startswith('=') or remaining[0] == 'sudo'):
+    remaining.pop(0)
+
+  return paths, remaining
+
+
+def invalidate_command(cmd):
+  """Invalidates the paths the command creates or deletes, when run in env.cwd."""
+  if env.host_string not in hosts:
+    return
+
+  cache = hosts[env.host_string]
+  cwd = env.cwd
+  for segment in split_command(cmd):
+    if segment is None:
+      cwd = env.cwd
+      continue
+
+    try:
+      tokens = shlex.split(segment)
+    except ValueError:
+      cache.clear()
+      return
+
+    paths, tokens = get_modified_paths(tokens)
+    if tokens:
+      name = posixpath.basename(tokens[0])
+      args = tokens[1:]
+      if name == 'cd':
+        cwd = resolve(args[0], cwd) if args else None
+      elif name in MODIFYING:
+        paths += [ arg for arg in args if not arg.startswith('-') ]
+      elif name not in READ_ONLY:
+        # Unknown commands might create, move or delete any file.
+        cache.clear()
+        return
+
+    for path in paths:
+      key = resolve(path, cwd)
+      if not key:
+        cache.clear()
+        return
+      invalidate(key)
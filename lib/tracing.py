@@ -0,0 +1,128 @@
+import atexit
+import itertools
+import json
+import os
+import threading
+import time
+from fabric.colors import yellow
+from fabric.state import env
+
+# Records spans for tasks, phases, method-hooks and commands. Enable it with
+# `fab --set trace=<file>`, add `traceFormat=chrome` to write the file in the
+# chrome trace-event-format (chrome://tracing) instead of a plain list.
+
+active = None
+filename = False
+spans = []
+stack = []
+counter = itertools.count()
+
+
+class Span(object):
+
+  def __init__(self, name, category, args):
+    self.data = {
+      'name': name,
+      'category': category,
+      'host': env.host_string,
+      'pid': os.getpid(),
+      'tid': threading.current_thread().ident,
+      'args': args
+    }
+
+  def __enter__(self):
+    self.data['parent'] = stack[-1].data['id'] if stack else False
+    self.data['id'] = '%d-%d' % (os.getpid(), next(counter))
+    stack.append(self)
+    self.data['start'] = time.time()
+    return self
+
+  def __exit__(self, type, value, traceback):
+    self.data['duration'] = time.time() - self.data['start']
+    if type is SystemExit and value.code is not None:
+      self.data['args']['exitCode'] = value.code if isinstance(value.code, int) else 1
+    elif type:
+      self.data['args']['error'] = repr(value)
+    stack.remove(self)
+    spans.append(self.data)
+
+  def set(self, **kwargs):
+    self.data['args'].update(kwargs)
+
+
+class NullSpan(object):
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type, value, traceback):
+    pass
+
+  def set(self, **kwargs):
+    pass
+
+null_span = NullSpan()
+
+
+def enabled():
+  global active, filename
+
+  if active is None:
+    filename = env.get('trace', False)
+    active = bool(filename)
+    if filename is True:
+      filename = 'trace.json'
+    if active:
+      atexit.register(export)
+
+  return active
+
+
+def span(name, category, **args):
+  if not enabled():
+    return null_span
+
+  return Span(name, category, args)
+
+
+def reset():
+  """Forgets all finished spans, e.g. in a forked process which reports its spans to the parent."""
+  del spans[:]
+
+
+def merge(other_spans):
+  spans.extend(other_spans)
+
+
+def get_chrome_trace():
+  events = []
+  start_time = min(s['start'] for s in spans) if spans else 0
+  for s in sorted(spans, key=lambda s: s['start']):
+    args = dict(s['args'])
+    args['host'] = s['host']
+    events.append({
+      'name': s['name'],
+      'cat': s['category'],
+      'ph': 'X',
+      'ts': int((s['start'] - start_time) * 1000000),
+      'dur': int(s['duration'] * 1000000),
+      'pid': s['pid'],
+      'tid': s['tid'],
+      'args': args
+    })
+
+  return { 'traceEvents': events, 'displayTimeUnit': 'ms' }
+
+
+def export():
+  if not filename:
+    return
+
+  if env.get('traceFormat') == 'chrome':
+    data = get_chrome_trace()
+  else:
+    data = sorted(spans, key=lambda s: s['start'])
+
+  with open(filename, 'w') as stream:
+    json.dump(data, stream, indent=2, default=str)
+  print yellow('Trace with %d spans written to %s' % (len(spans), filename))
@@ -0,0 +1,372 @@
+import errno
+import itertools
+import json
+import os
+import os.path
+import socket
+import SocketServer
+import subprocess
+import sys
+import threading
+import time
+from fabric.colors import yellow
+
+# Keeps ssh-tunnels alive between fab-invocations. Enable it with
+# `fab --set tunnelBroker[=<seconds>]`: the first invocation starts a broker in
+# the background listening on ~/.fabalicious/tunnels.sock. Invocations ask the
+# broker for their tunnels and stay attached until they exit; tunnels without
+# attached invocations are closed after being idle for the given seconds, the
+# broker exits when it has nothing to do anymore.
+
+IDLE_TIMEOUT = 600
+
+# Interval of the health-checks and idle-expiry in the broker.
+CHECK_INTERVAL = 10
+
+# The connection of this process to the broker.
+connection = False
+connection_pid = False
+
+
+def get_folder():
+  return os.path.expanduser('~/.fabalicious')
+
+
+def get_socket_filename():
+  return os.path.join(get_folder(), 'tunnels.sock')
+
+
+def get_idle_timeout():
+  from fabric.state import env
+  value = env.get('tunnelBroker', False)
+  return IDLE_TIMEOUT if value is True else int(value)
+
+
+def enabled():
+  from fabric.state import env
+  from lib import executor
+  return bool(env.get('tunnelBroker', False)) and not executor.is_recording()
+
+
+class Connection(object):
+  """A connection to the broker, sending and receiving json-lines."""
+
+  def __init__(self, filename):
+    self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.socket.connect(filename)
+    self.stream = self.socket.makefile('r')
+
+  def request(self, action, **kwargs):
+    kwargs['action'] = action
+    self.socket.sendall(json.dumps(kwargs) + '\n')
+    line = self.stream.readline()
+    if not line:
+      raise IOError('The tunnel-broker closed the connection.')
+    return json.loads(line)
+
+  def close(self):
+    self.stream.close()
+    self.socket.close()
+
+
+def connect(start=True, timeout=10):
+  """Returns the connection to the broker, starts the broker if needed, False if it is not running."""
+  global connection, connection_pid
+
+  # Forked processes need their own connection.
+  if connection and connection_pid == os.getpid():
+    return connection
+
+  filename = get_socket_filename()
+  deadline = time.time() + timeout
+  started = False
+  while True:
+    try:
+      connection = Connection(filename)
+      connection_pid = os.getpid()
+      return connection
+    except socket.error as e:
+      if e.errno not in [ errno.ENOENT, errno.ECONNREFUSED ]:
+        raise
+      if not start or time.time() > deadline:
+        return False
+
+    if not started:
+      start_broker(filename, get_idle_timeout())
+      started = True
+    time.sleep(0.1)
+
+
+def start_broker(filename, idle_timeout):
+  folder = os.path.dirname(filename)
+  if not os.path.exists(folder):
+    os.makedirs(folder)
+
+  with open(os.devnull, 'r') as devnull, open(os.path.join(folder, 'tunnels.log'), 'a') as log:
+    subprocess.Popen(
+      [ sys.executable, os.path.realpath(__file__).replace('.pyc', '.py'), 'serve', filename, str(idle_timeout) ],
+      stdin=devnull, stdout=log, stderr=log, close_fds=True, preexec_fn=os.setsid)
+
+
+def open_tunnel(**options):
+  """Returns the local port of a live tunnel for the options, the tunnel is kept while this process runs."""
+  broker = connect()
+  if not broker:
+    raise IOError('Could not start the tunnel-broker, see %s' % os.path.join(get_folder(), 'tunnels.log'))
+  result = broker.request('open', options=options)
+  if not result['ok']:
+    raise IOError(result['error'])
+  return result['tunnel']
+
+
+def list_tunnels():
+  broker = connect(start=False)
+  if not broker:
+    return False
+  return broker.request('list')['tunnels']
+
+
+def close_tunnels(tunnel_id=False):
+  broker = connect(start=False)
+  if not broker:
+    return False
+  return broker.request('close', id=tunnel_id)['closed']
+
+
+def print_tunnels(tunnels):
+  if tunnels is False:
+    print yellow('No tunnel-broker running.')
+    return
+  if not tunnels:
+    print 'No tunnels open.'
+    return
+
+  print '%4s  %-30s  %-25s  %6s  %7s  %5s  %7s' % ('Id', 'Bridge', 'Destination', 'Port', 'Pid', 'Users', 'Idle')
+  for t in tunnels:
+    bridge = '%s@%s:%s' % (t['bridgeUser'], t['bridgeHost'], t['bridgePort'])
+    dest = '%s:%s' % (t['destHost'], t['destPort'])
+    idle = '-' if t['users'] else '%ds' % t['idle']
+    print '%4d  %-30s  %-25s  %6s  %7d  %5d  %7s' % (t['id'], bridge, dest, t['localPort'], t['pid'], t['users'], idle)
+
+
+class BrokerTunnel(object):
+  """A tunnel kept by the broker, looks like lib.utils.SSHTunnel to its users."""
+
+  def __init__(self, data):
+    self.local_port = data['localPort']
+    self.data = data
+
+  def entrance(self):
+    return 'localhost:%d' % self.local_port
+
+  def alive(self):
+    # The broker replaces dead tunnels.
+    return True
+
+  def terminate(self):
+    # The broker releases the tunnel when this process disconnects.
+    pass
+
+
+# The broker itself.
+
+# Tunnels are shared by bridge and destination, the local port of the first
+# request wins.
+KEY = [ 'bridgeUser', 'bridgeHost', 'bridgePort', 'destHost', 'destPort' ]
+
+
+class Tunnel(object):
+
+  def __init__(self, tunnel_id, options, ssh_tunnel):
+    self.id = tunnel_id
+    self.options = options
+    self.ssh_tunnel = ssh_tunnel
+    self.users = 0
+    self.last_used = time.time()
+
+  def is_healthy(self):
+    from lib.utils import is_port_open
+    return self.ssh_tunnel.p.poll() is None and is_port_open(self.options['localPort'])
+
+  def close(self):
+    self.ssh_tunnel.p.poll()
+    self.ssh_tunnel.terminate()
+
+  def get_data(self):
+    data = dict((key, self.options[key]) for key in KEY + [ 'localPort' ])
+    data.update({
+      'id': self.id,
+      'pid': self.ssh_tunnel.p.pid,
+      'users': self.users,
+      'idle': int(time.time() - self.last_used)
+    })
+    return data
+
+
+class Broker(object):
+
+  def __init__(self, idle_timeout):
+    self.idle_timeout = idle_timeout
+    self.tunnels = {}
+    self.clients = 0
+    self.last_used = time.time()
+    self.ids = itertools.count(1)
+    self.lock = threading.RLock()
+    # Keys of the tunnels being opened, opened is notified when one is done.
+    self.opening = set()
+    self.opened = threading.Condition(self.lock)
+
+  def open(self, options, attached):
+    from lib.utils import SSHTunnel
+
+    key = tuple(options[key] for key in KEY)
+    with self.lock:
+      # Wait for another client opening the same tunnel.
+      while key in self.opening:
+        self.opened.wait()
+
+      tunnel = self.tunnels.get(key)
+      if tunnel and not tunnel.is_healthy():
+        print 'Tunnel %d is not healthy anymore, reopening it.' % tunnel.id
+        self.remove(key)
+        tunnel = False
+
+      if tunnel:
+        return self.attach(tunnel, attached)
+
+      self.opening.add(key)
+
+    # Opening a tunnel takes a while, do not block other clients meanwhile.
+    ssh_tunnel = False
+    try:
+      ssh_tunnel = SSHTunnel(options['bridgeUser'], options['bridgeHost'], options['destHost'], options['bridgePort'], options['destPort'], options['localPort'], options.get('strictHostKeyChecking', True))
+    except SystemExit:
+      pass
+    finally:
+      with self.lock:
+        self.opening.discard(key)
+        self.opened.notify_all()
+
+        if ssh_tunnel:
+          tunnel = Tunnel(next(self.ids), options, ssh_tunnel)
+          self.tunnels[key] = tunnel
+          print 'Opened tunnel %d: %s' % (tunnel.id, json.dumps(tunnel.get_data()))
+          data = self.attach(tunnel, attached)
+
+    if not ssh_tunnel:
+      raise IOError('Could not open tunnel to %s:%s via %s' % (options['destHost'], options['destPort'], options['bridgeHost']))
+
+    return data
+
+  def attach(self, tunnel, attached):
+    tunnel.users += 1
+    tunnel.last_used = time.time()
+    attached.append(tunnel)
+    return tunnel.get_data()
+
+  def release(self, attached):
+    with self.lock:
+      for tunnel in attached:
+        tunnel.users -= 1
+        tunnel.last_used = time.time()
+      self.last_used = time.time()
+
+  def remove(self, key):
+    tunnel = self.tunnels.pop(key)
+    tunnel.close()
+    print 'Closed tunnel %d.' % tunnel.id
+
+  def close(self, tunnel_id):
+    closed = []
+    with self.lock:
+      for key, tunnel in self.tunnels.items():
+        if not tunnel_id or tunnel.id == int(tunnel_id):
+          self.remove(key)
+          closed.append(tunnel.id)
+    return closed
+
+  def list(self):
+    with self.lock:
+      return sorted([ tunnel.get_data() for tunnel in self.tunnels.values() ], key=lambda t: t['id'])
+
+  def check(self):
+    """Closes dead and idle tunnels, returns False if the broker is not needed anymore."""
+    now = time.time()
+    with self.lock:
+      for key, tunnel in self.tunnels.items():
+        if not tunnel.is_healthy():
+          print 'Tunnel %d is not healthy anymore.' % tunnel.id
+          self.remove(key)
+        elif not tunnel.users and now - tunnel.last_used > self.idle_timeout:
+          self.remove(key)
+
+      return self.tunnels or self.clients or now - self.last_used < self.idle_timeout
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+
+  def handle(self):
+    broker = self.server.broker
+    attached = []
+    with broker.lock:
+      broker.clients += 1
+    try:
+      for line in iter(self.rfile.readline, ''):
+        request = json.loads(line)
+        try:
+          if request['action'] == 'open':
+            result = { 'ok': True, 'tunnel': broker.open(request['options'], attached) }
+          elif request['action'] == 'list':
+            result = { 'ok': True, 'tunnels': broker.list() }
+          elif request['action'] == 'close':
+            result = { 'ok': True, 'closed': broker.close(request.get('id')) }
+          else:
+            result = { 'ok': False, 'error': 'Unknown action %s' % request['action'] }
+        except Exception as e:
+          result = { 'ok': False, 'error': str(e) }
+
+        self.wfile.write(json.dumps(result) + '\n')
+        self.wfile.flush()
+    finally:
+      with broker.lock:
+        broker.clients -= 1
+      broker.release(attached)
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  daemon_threads = True
+
+
+def serve(filename, idle_timeout):
+  # Another broker might have started in the meantime.
+  try:
+    Connection(filename).close()
+    return
+  except socket.error:
+    if os.path.exists(filename):
+      os.unlink(filename)
+
+  broker = Broker(idle_timeout)
+  server = Server(filename, RequestHandler)
+  os.chmod(filename, 0600)
+  server.broker = broker
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  print 'Tunnel-broker %d listening on %s' % (os.getpid(), filename)
+  sys.stdout.flush()
+
+  try:
+    while broker.check():
+      sys.stdout.flush()
+      time.sleep(CHECK_INTERVAL)
+  finally:
+    server.shutdown()
+    os.unlink(filename)
+    broker.close(False)
+    print 'Tunnel-broker %d stopped.' % os.getpid()
+
+
+if __name__ == '__main__':
+  sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+  serve(sys.argv[2], int(sys.argv[3]))
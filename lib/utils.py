@@ -1,5 +1,9 @@
 from fabric.api import *
 import subprocess, shlex, atexit, time
+import collections
+import random
+import socket
+import threading
 import time
 from fabric.colors import red
 
@@ -7,33 +11,50 @@ ssh_no_strict_key_host_checking_params = '-o StrictHostKeyChecking=no -o UserKno
 
 class TunnelBase:
 
-  def waitForInteractiveSessions(self, timeout, waitForSendingCommand):
-    start_time = time.time()
-    connectionEstablished = False
-    commandSent = not waitForSendingCommand
-    terminated = False
-    output = ''
-    while not connectionEstablished and not terminated:
-      line = self.p.stderr.readline()
-      output += line
+  def start(self, cmd, waitForSendingCommand):
+    self.cmd = cmd
+    self.output = collections.deque(maxlen=100)
+    self.established = False
+    self.p = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    atexit.register(self.terminate)
 
-      self.p.poll()
-      if self.p.returncode != None:
-        terminated = True
+    # Read the output in the background, ssh stalls when the pipe is full.
+    self.drain_thread = threading.Thread(target=self.drain, args=(waitForSendingCommand,))
+    self.drain_thread.daemon = True
+    self.drain_thread.start()
+
+  def drain(self, waitForSendingCommand):
+    commandSent = not waitForSendingCommand
+    for line in iter(self.p.stdout.readline, ''):
+      self.output.append(line)
 
       if "Sending command" in line:
         commandSent = True
 
       if commandSent and 'Entering interactive session' in line:
-        connectionEstablished = True
+        self.established = True
+
+  def isReady(self, timeout):
+    return self.established
 
-      if time.time() > start_time + timeout:
-        terminated = True
+  def waitUntilReady(self, timeout):
+    deadline = time.time() + timeout
+    delay = 0.05
+    while self.p.poll() == None and time.time() < deadline:
+      if self.isReady(min(deadline - time.time(), 1)):
+        return
 
-    if not connectionEstablished:
-      print red("Could not establish tunnel with command %s" % self.cmd)
-      print output
-      exit(1)
+      time.sleep(max(min(delay, deadline - time.time()), 0))
+      delay = min(delay * 2, 0.5)
+
+    if self.p.returncode != None:
+      self.drain_thread.join(1)
+    print red("Could not establish tunnel with command %s" % self.cmd)
+    print ''.join(self.output)
+    exit(1)
+
+  def alive(self):
+    return self.p.poll() == None
 
   def terminate(self):
     if self.p.returncode == None:
@@ -64,11 +85,12 @@ class SSHTunnel(TunnelBase):
   def __init__(self, bridge_user, bridge_host, dest_host, bridge_port=22, dest_port=22, local_port=2022, strictHostKeyChecking = True, timeout=45):
     self.local_port = local_port
 
-    self.cmd = cmd = self.getSSHCommand(bridge_user, bridge_host, dest_host, bridge_port, dest_port, local_port, strictHostKeyChecking)
+    self.start(self.getSSHCommand(bridge_user, bridge_host, dest_host, bridge_port, dest_port, local_port, strictHostKeyChecking), False)
+    self.waitUntilReady(timeout)
 
-    self.p = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    atexit.register(self.terminate)
-    self.waitForInteractiveSessions(timeout, False)
+  def isReady(self, timeout):
+    # The local port accepts connections once ssh is forwarding it.
+    return is_port_open(self.local_port, timeout=max(timeout, 0.1))
 
   def entrance(self):
     return 'localhost:%d' % self.local_port
@@ -117,17 +139,45 @@ class RemoteSSHTunnel(TunnelBase):
     self.bridge_host = bridge_host
     self.bridge_user = bridge_user
 
-    self.cmd = cmd = self.getSSHCommand(config, bridge_user, bridge_host, dest_host, bridge_port, dest_port, local_port, strictHostKeyChecking)
+    # The port is opened on the remote host, the ssh-client running there
+    # enters its session after setting up the forwarding.
+    self.start(self.getSSHCommand(config, bridge_user, bridge_host, dest_host, bridge_port, dest_port, local_port, strictHostKeyChecking), True)
+    self.waitUntilReady(timeout)
+
+  def entrance(self):
+    return 'localhost:%d' % self.local_port
 
-    self.p = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-    atexit.register(self.terminate)
-    self.waitForInteractiveSessions(timeout, True)
+def is_port_open(port, host='127.0.0.1', timeout=1):
+  """Returns True if something accepts connections on the port."""
+  try:
+    connection = socket.create_connection((host, port), timeout)
+  except (socket.error, socket.timeout):
+    return False
 
-    time.sleep(5)
+  connection.close()
+  return True
 
-  def entrance(self):
-    return 'localhost:%d' % self.local_port
+
+allocated_ports = set()
+
+def allocate_port(start=1025, end=65535):
+  """Returns a random local port which is free and was not returned before."""
+  while True:
+    port = random.randrange(start, end)
+    if port in allocated_ports:
+      continue
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+      s.bind(('127.0.0.1', port))
+    except socket.error:
+      continue
+    finally:
+      s.close()
+
+    allocated_ports.add(port)
+    return port
 
 
 def validate_dict(keys, dict, section=False):